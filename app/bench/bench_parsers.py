@@ -0,0 +1,227 @@
+"""Offline benchmark and regression check for the store parsers.
+
+Fixtures live in fixtures/<STORE>/<case>/: case.json describes the product url,
+the recorded HTTP exchanges and the expected variants; response bodies are
+stored next to it. Record a case against the live store once:
+
+    python bench_parsers.py record B24 https://www.bike24.com/p2123456.html
+
+and benchmark every recorded case with the network layer replaced by fixtures:
+
+    python bench_parsers.py run --iterations 50 --output after.json --compare before.json
+
+A run exits with status 1 when a parser returns variants that differ from the
+recorded ones. The bundled fixtures are hand-written synthetic pages, marked with
+"synthetic": true in case.json, that only cover the parsing paths; record real
+pages before drawing conclusions from the timings.
+"""
+import argparse
+import asyncio
+import json
+import resource
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from statistics import quantiles
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+import clients
+import parsing
+from constants import STATUS_OK
+
+FIXTURES_DIR = Path(__file__).resolve().parent / 'fixtures'
+HTTP_TIMEOUT = 30
+
+
+class RecordingRegistry(clients.ClientRegistry):
+    def __init__(self):
+        super().__init__()
+        self.exchanges = []
+
+    async def request(self, store, method, url, timeout, **kwargs) -> clients.Response:
+        response = await super().request(store, method, url, timeout, **kwargs)
+        self.exchanges.append((method, url, response))
+        return response
+
+
+class FixtureRegistry(clients.ClientRegistry):
+    def __init__(self, case_dir: Path, exchanges: list[dict]):
+        super().__init__()
+        self.responses = {}
+        for exchange in exchanges:
+            self.responses[(exchange['method'], exchange['url'])] = clients.Response(
+                status=exchange['status'],
+                url=exchange['final_url'],
+                text=(case_dir / exchange['body']).read_text(encoding='utf-8'),
+                headers=exchange.get('headers', {}),
+                cookies=exchange.get('cookies', {})
+            )
+
+    async def request(self, store, method, url, timeout, **kwargs) -> clients.Response:
+        try:
+            return self.responses[(method, url)]
+        except KeyError:
+            raise LookupError(f'No recorded response for {method} {url}') from None
+
+
+def normalize(variants: dict) -> dict:
+    # Expected variants went through JSON, so integer sku ids come back as strings
+    return json.loads(json.dumps(variants))
+
+
+async def parse_case(store: str, case_dir: Path) -> tuple[dict, dict]:
+    case = json.loads((case_dir / 'case.json').read_text(encoding='utf-8'))
+    clients.registry = FixtureRegistry(case_dir, case['exchanges'])
+    result = await getattr(parsing, 'parse' + store)(case['url'], HTTP_TIMEOUT)
+    return case, result
+
+
+def load_cases(stores: list[str] | None) -> dict[str, list[Path]]:
+    cases = {}
+    for store_dir in sorted(FIXTURES_DIR.iterdir()):
+        if not store_dir.is_dir() or (stores and store_dir.name not in stores):
+            continue
+        store_cases = sorted(path.parent for path in store_dir.glob('*/case.json'))
+        if store_cases:
+            cases[store_dir.name] = store_cases
+    return cases
+
+
+async def record(store: str, url: str, name: str | None):
+    registry = RecordingRegistry()
+    clients.registry = registry
+    try:
+        result = await getattr(parsing, 'parse' + store)(url, HTTP_TIMEOUT)
+    finally:
+        await registry.close()
+
+    if result['status'] != STATUS_OK:
+        sys.exit(f'{store} parser returned status {result["status"]}, nothing recorded')
+
+    first_variant = next(iter(result['variants'].values()), {})
+    case_dir = FIXTURES_DIR / store / (name or first_variant.get('prodid', 'case'))
+    case_dir.mkdir(parents=True, exist_ok=True)
+    exchanges = []
+    for index, (method, request_url, response) in enumerate(registry.exchanges):
+        body = f'response{index}.txt'
+        (case_dir / body).write_text(response.text, encoding='utf-8')
+        exchanges.append({
+            'method': method,
+            'url': request_url,
+            'status': response.status,
+            'final_url': response.url,
+            'cookies': response.cookies,
+            'body': body
+        })
+
+    case = {'url': url, 'exchanges': exchanges, 'expected': normalize(result['variants'])}
+    (case_dir / 'case.json').write_text(json.dumps(case, ensure_ascii=False, indent=2), encoding='utf-8')
+    print(f'Recorded {len(exchanges)} responses and {len(result["variants"])} variants to {case_dir}')
+
+
+def bench_store(store: str, case_dirs: list[Path], iterations: int) -> dict:
+    parse_function = getattr(parsing, 'parse' + store)
+    timings = []
+    mismatches = []
+    synthetic = 0
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    async def run_case(case_dir: Path):
+        nonlocal synthetic
+        case = json.loads((case_dir / 'case.json').read_text(encoding='utf-8'))
+        synthetic += case.get('synthetic', False)
+        clients.registry = FixtureRegistry(case_dir, case['exchanges'])
+        for iteration in range(iterations):
+            started = perf_counter()
+            result = await parse_function(case['url'], HTTP_TIMEOUT)
+            timings.append(perf_counter() - started)
+            if iteration == 0 and (result['status'] != STATUS_OK or normalize(result['variants']) != case['expected']):
+                mismatches.append(case_dir.name)
+
+    async def run_all():
+        for case_dir in case_dirs:
+            await run_case(case_dir)
+
+    asyncio.run(run_all())
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    percentiles = quantiles(timings, n=100, method='inclusive') if len(timings) > 1 else timings * 99
+    return {
+        'store': store,
+        'cases': len(case_dirs),
+        'synthetic': synthetic,
+        'pages': len(timings),
+        'pages_per_sec': len(timings) / sum(timings),
+        'p50_ms': percentiles[49] * 1000,
+        'p99_ms': percentiles[98] * 1000,
+        'peak_rss_kb': rss_after,
+        'rss_growth_kb': rss_after - rss_before,
+        'mismatches': mismatches
+    }
+
+
+def run(stores: list[str] | None, iterations: int, output: str | None, compare: str | None):
+    cases = load_cases(stores)
+    if not cases:
+        sys.exit(f'No fixtures found in {FIXTURES_DIR}')
+
+    results = {}
+    for store, case_dirs in cases.items():
+        # A fresh process per store keeps the peak RSS figures separate
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results[store] = executor.submit(bench_store, store, case_dirs, iterations).result()
+
+    baseline = json.loads(Path(compare).read_text()) if compare else {}
+    print(f'{"store":<6}{"cases":>6}{"pages/s":>10}{"p50 ms":>9}{"p99 ms":>9}{"peak RSS MB":>13}  status')
+    for store, stats in results.items():
+        line = (
+            f'{store:<6}{stats["cases"]:>6}{stats["pages_per_sec"]:>10.1f}{stats["p50_ms"]:>9.2f}'
+            f'{stats["p99_ms"]:>9.2f}{stats["peak_rss_kb"] / 1024:>13.1f}  '
+        )
+        line += 'MISMATCH: ' + ', '.join(stats['mismatches']) if stats['mismatches'] else 'ok'
+        if stats['synthetic']:
+            line += f' ({stats["synthetic"]} synthetic)'
+        if store in baseline:
+            change = stats['p50_ms'] / baseline[store]['p50_ms'] - 1
+            line += f' (p50 {change:+.0%} vs baseline)'
+        print(line)
+
+    synthetic = sum(stats['synthetic'] for stats in results.values())
+    if synthetic:
+        print(
+            f'{synthetic} of {sum(stats["cases"] for stats in results.values())} cases are synthetic pages, '
+            'not captured from the stores: record real ones before comparing timings'
+        )
+
+    if output:
+        Path(output).write_text(json.dumps(results, indent=2))
+
+    if any(stats['mismatches'] for stats in results.values()):
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline parser benchmark')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = subparsers.add_parser('record', help='record a fixture from the live store')
+    record_parser.add_argument('store')
+    record_parser.add_argument('url')
+    record_parser.add_argument('--name', help='case directory name (defaults to the product id)')
+
+    run_parser = subparsers.add_parser('run', help='benchmark parsers against recorded fixtures')
+    run_parser.add_argument('--store', action='append', dest='stores', help='limit to a store (repeatable)')
+    run_parser.add_argument('--iterations', type=int, default=20)
+    run_parser.add_argument('--output', help='write results as JSON')
+    run_parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+
+    args = parser.parse_args()
+    if args.command == 'record':
+        asyncio.run(record(args.store, args.url, args.name))
+    else:
+        run(args.stores, args.iterations, args.output, args.compare)
+
+
+if __name__ == '__main__':
+    main()
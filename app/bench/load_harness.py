@@ -0,0 +1,247 @@
+"""End-to-end crawl load test against the replay server and a local MongoDB.
+
+Seeds a throwaway database with synthetic users and SKUs spread over the
+fixture pages, runs one checkSKU pass and drains the notification outbox with all store
+traffic routed to replay_server.py and Telegram replaced by a counting stub,
+then reports pass duration, requests per store and notifications produced.
+
+    python replay_server.py --price-flip-rate 0.05 &
+    python load_harness.py --skus 100000 --db bikedealsbot_loadtest
+
+The database named by --db is dropped before seeding.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+from collections import Counter
+from pathlib import Path
+from time import perf_counter, time
+
+from bench_parsers import load_cases
+
+STORE_SETTINGS = {
+    'SB': ('https://www.starbike.com', r'starbike\.com'),
+    'BC': ('https://www.bike-components.de', r'bike-components\.de'),
+    'BD': ('https://www.bike-discount.de', r'bike-discount\.de'),
+    'TI': ('https://www.tradeinn.com', r'tradeinn\.com'),
+    'B24': ('https://www.bike24.com', r'bike24\.(com|de)'),
+    'CRC': ('https://www.chainreactioncycles.com', r'chainreactioncycles\.com'),
+    'A4C': ('https://www.all4cycling.com', r'all4cycling\.com'),
+    'LG': ('https://www.lordgun.com', r'lordgun\.com'),
+}
+
+
+class SentMessage:
+    def __init__(self, message_id: int):
+        self.message_id = message_id
+
+
+class CountingBot:
+    id = 0
+    token = '0:loadtest'
+
+    def __init__(self):
+        self.messages = Counter()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.messages[str(chat_id)] += 1
+        return SentMessage(sum(self.messages.values()))
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        self.messages[str(chat_id)] += 1
+
+    async def pin_chat_message(self, chat_id, message_id, **kwargs):
+        pass
+
+    async def send_chat_action(self, chat_id, action, **kwargs):
+        pass
+
+
+def settings_document(concurrency: int) -> dict:
+    return {
+        '_id': 'settings',
+        'TOKEN': CountingBot.token,
+        'ADMINCHATID': 0,
+        'BESTDEALSCHATID': None,
+        'BESTDEALSMINPERCENTAGE': 20,
+        'BESTDEALSWARNPERCENTAGE': 40,
+        'BESTDEALSMINVALUE': {},
+        'CACHELIFETIME': 0,
+        'ERRORMINTHRESHOLD': 3,
+        'ERRORMAXDAYS': 30,
+        'MAXITEMSPERUSER': 1000,
+        'CHECKINTERVAL': 60,
+        'LOGCHATID': None,
+        'LOGFILTER': [],
+        'BANNERSTART': '',
+        'BANNERHELP': '',
+        'BANNERDONATE': '',
+        'DEBUG': False,
+        'HTTPTIMEOUT': 30,
+        'REQUESTDELAY': 0,
+        'STORES': {
+            store: {
+                'url': url,
+                'url_regex': url_regex,
+                'active': True,
+                'price_threshold': 0.01,
+                'concurrency': concurrency,
+                'request_delay': 0
+            }
+            for store, (url, url_regex) in STORE_SETTINGS.items()
+        }
+    }
+
+
+async def seed(db, sku_count: int, subscribers: int, skus_per_user: int, concurrency: int):
+    cases = []
+    for store, case_dirs in load_cases(None).items():
+        for case_dir in case_dirs:
+            case = json.loads((case_dir / 'case.json').read_text(encoding='utf-8'))
+            if case['expected']:
+                cases.append((store, case))
+    if not cases:
+        sys.exit('No fixtures with variants found, record some with bench_parsers.py first')
+
+    await db.settings.insert_one(settings_document(concurrency))
+
+    user_count = max(sku_count // skus_per_user, 1)
+    await db.users.insert_many([
+        {
+            '_id': str(100000 + index),
+            'first_name': f'User {index}',
+            'last_name': '',
+            'username': '',
+            'enable': True,
+            'broadcasts': []
+        }
+        for index in range(user_count)
+    ])
+
+    batch = []
+    for index in range(sku_count):
+        product_index = index // subscribers
+        store, case = cases[product_index % len(cases)]
+        skuid, variant = next(iter(case['expected'].items()))
+        prodid = f'lt{product_index}'
+        separator = '&' if '?' in case['url'] else '?'
+        chat_id = str(100000 + index % user_count)
+        batch.append({
+            '_id': f'{chat_id}_{store}_{prodid}_{skuid}_{index}',
+            'store': store,
+            'prodid': prodid,
+            'skuid': skuid,
+            'url': f'{case["url"]}{separator}lt={product_index}',
+            'name': variant['name'],
+            'variant': variant['variant'],
+            'price': variant['price'],
+            'currency': variant['currency'],
+            'instock': variant['instock'],
+            'store_prodid': f'{store}_{prodid}',
+            'chat_id': chat_id,
+            'errors': 0,
+            'enable': True,
+            'lastcheck': '',
+            'lastcheckts': 0,
+            'lastgoodts': 0
+        })
+        if len(batch) == 10000:
+            await db.sku.insert_many(batch)
+            batch = []
+    if batch:
+        await db.sku.insert_many(batch)
+
+    print(f'Seeded {sku_count} SKUs over {-(-sku_count // subscribers)} products and {user_count} users')
+
+
+async def replay_stats(replay_url: str, reset: bool = False) -> dict:
+    from aiohttp import ClientSession
+
+    async with ClientSession() as session:
+        if reset:
+            async with session.post(f'{replay_url}/_stats/reset'):
+                return {}
+        async with session.get(f'{replay_url}/_stats') as response:
+            return await response.json()
+
+
+async def run(args):
+    os.environ['CONNSTRING'] = args.connstring
+    os.environ['DBNAME'] = args.db
+    os.environ['STORE_HOST_OVERRIDE'] = args.replay_url
+    os.environ['PARSE_WORKERS'] = str(args.parse_workers)
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+    import app
+    import clients
+    import parsing
+    from database import close_database, db
+
+    await db.client.drop_database(args.db)
+    await seed(db, args.skus, args.subscribers, args.skus_per_user, args.concurrency)
+
+    await app.load_settings()
+    await app.syncSchedule()
+    app.bot = CountingBot()
+    await clients.registry.open()
+    app.delivery.start()
+    if args.parse_workers:
+        parsing.start_parse_pool(args.parse_workers)
+    await replay_stats(args.replay_url, reset=True)
+    app.leader.start()
+    await app.leader.elected.wait()
+
+    try:
+        started = perf_counter()
+        circuit_seconds = 0.0
+        while await app.schedule_repository.count_due(int(time())):
+            if sum(await asyncio.gather(*(app.crawlStore(store) for store in app.crawlableStores()))):
+                continue
+            # Nothing claimable: sleep until an open circuit lets a probe through
+            wait = app.crawler.reopens_in()
+            if wait is None:
+                # Due products of inactive stores are never claimed
+                break
+            paused = perf_counter()
+            await asyncio.sleep(max(wait, 0.1))
+            circuit_seconds += perf_counter() - paused
+        crawl_seconds = perf_counter() - started
+
+        started = perf_counter()
+        while await app.drainOutbox(app.leader.token):
+            pass
+        notify_seconds = perf_counter() - started
+    finally:
+        await app.leader.stop()
+        await app.delivery.stop()
+        parsing.stop_parse_pool()
+        await clients.registry.close()
+
+    stats = await replay_stats(args.replay_url)
+    checked = await db.sku.count_documents({'lastcheckts': {'$gt': 0}})
+    await close_database()
+
+    print(f'checkSKU pass: {crawl_seconds:.1f}s ({circuit_seconds:.1f}s waiting on open circuits), {checked} SKUs checked')
+    print(f'notify pass: {notify_seconds:.1f}s, {sum(app.bot.messages.values())} messages to {len(app.bot.messages)} chats')
+    for host, counters in sorted(stats.items()):
+        details = ', '.join(f'{name}: {value}' for name, value in sorted(counters.items()))
+        print(f'  {host}: {details}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Crawl load test against the replay server')
+    parser.add_argument('--connstring', default='mongodb://localhost:27017')
+    parser.add_argument('--db', default='bikedealsbot_loadtest')
+    parser.add_argument('--replay-url', default='http://127.0.0.1:9000')
+    parser.add_argument('--skus', type=int, default=100000)
+    parser.add_argument('--subscribers', type=int, default=3, help='SKUs per synthetic product')
+    parser.add_argument('--skus-per-user', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=8, help='crawl concurrency per store')
+    parser.add_argument('--parse-workers', type=int, default=os.cpu_count() or 1)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
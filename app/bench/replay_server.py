@@ -0,0 +1,207 @@
+"""Local stand-in for the supported stores, serving the recorded fixtures.
+
+Point the crawler at it with STORE_HOST_OVERRIDE=http://127.0.0.1:9000: every
+store request then arrives here as /<original host>/<path>. The "lt" query
+parameter is ignored when looking up a recording, so load tests can spread any
+number of synthetic products over the same fixture pages.
+
+    python replay_server.py --latency-ms 300 --error-rate 0.02 --price-flip-rate 0.05
+
+GET /_stats returns per-host request counters, POST /_stats/reset clears them.
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+from collections import defaultdict
+from time import time
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from aiohttp import web
+
+from bench_parsers import load_cases
+
+CHALLENGE_COOKIE = 'bm_replay'
+TIMEOUT_SLEEP = 120
+
+Q = r'(?:"|&quot;)'
+NUMBER = r'(-?\d+(?:\.\d+)?)'
+PRICE_PATTERNS = {
+    'B24': re.compile(Q + r'price' + Q + r'\s*:\s*' + Q + r'?' + NUMBER),
+    'TI': re.compile(r'"precio"\s*:\s*' + NUMBER),
+    'BC': re.compile(r'"price"\s*:\s*"?' + NUMBER),
+    'BD': re.compile(Q + r'unitPrice' + Q + r'\s*:\s*' + NUMBER),
+    'CRC': re.compile(r'"centAmount"\s*:\s*' + NUMBER),
+    'A4C': re.compile(r'\bprice\s*:\s*' + NUMBER),
+    'LG': re.compile(Q + r'price0' + Q + r'\s*:\s*' + Q + r'?' + NUMBER),
+    'SB': re.compile(r'dropdownbox-price[^>]*>[^0-9<]*' + NUMBER),
+}
+STOCK_SWAPS = {
+    'BC': [('InStock', 'OutOfStock')],
+    'BD': [('available&quot;:true', 'available&quot;:false')],
+    'CRC': [('"inStock":true', '"inStock":false')],
+    'A4C': [('available: true', 'available: false'), ('available:true', 'available:false')],
+}
+STOCK_COUNTERS = {
+    'B24': re.compile(r'("currentStock"\s*:\s*)(\d+)'),
+    'LG': re.compile(Q + r'quantity' + Q + r'\s*:\s*' + Q + r'?(\d+)'),
+}
+
+
+def strip_lt(url: str) -> str:
+    parsed = urlsplit(url)
+    query = urlencode([(key, value) for key, value in parse_qsl(parsed.query, keep_blank_values=True) if key != 'lt'])
+    return parsed._replace(query=query).geturl()
+
+
+def scale_price(match: re.Match, factor: float) -> str:
+    value = match.group(1)
+    scaled = float(value) * factor
+    new_value = f'{scaled:.2f}' if '.' in value else str(int(scaled))
+    start, end = match.span(1)
+    return match.group(0)[:start - match.start()] + new_value + match.group(0)[end - match.start():]
+
+
+def flip_stock(store: str, body: str) -> str:
+    for first, second in STOCK_SWAPS.get(store, []):
+        body = body.replace(first, '\0').replace(second, first).replace('\0', second)
+    counter = STOCK_COUNTERS.get(store)
+    if counter:
+        body = counter.sub(lambda m: m.group(0)[:-len(m.group(2))] + ('0' if m.group(2) != '0' else '5'), body)
+    return body
+
+
+def challenge_page(pow_base: int, pow_parts: list[str], token: str) -> str:
+    number = ' + '.join(f'"{part}"' for part in pow_parts)
+    return (
+        '<html><head><meta http-equiv="refresh" content="5; url=?bm-verify=' + token + '"></head><body>'
+        f'<script>var i = {pow_base}; var j = i + Number({number});</script>'
+        '<script>fetch("/_sec/verify?provider=interstitial", {method: "POST", body: JSON.stringify({'
+        f'"bm-verify": "{token}", "pow": j}})}});</script>'
+        '</body></html>'
+    )
+
+
+class ReplayServer:
+    def __init__(self, args):
+        self.args = args
+        self.exchanges = {}
+        self.stats = defaultdict(lambda: defaultdict(int))
+        self.challenges = {}
+        for store, case_dirs in load_cases(args.stores).items():
+            for case_dir in case_dirs:
+                case = json.loads((case_dir / 'case.json').read_text(encoding='utf-8'))
+                for exchange in case['exchanges']:
+                    body = (case_dir / exchange['body']).read_text(encoding='utf-8')
+                    entry = (store, exchange, body)
+                    self.exchanges[(exchange['method'], strip_lt(exchange['url']))] = entry
+                    self.exchanges.setdefault((exchange['method'], strip_lt(exchange['final_url'])), entry)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/_stats', self.stats_handler)
+        app.router.add_post('/_stats/reset', self.reset_handler)
+        app.router.add_route('*', '/{host}/{path:.*}', self.handler)
+        return app
+
+    async def stats_handler(self, request: web.Request):
+        return web.json_response(self.stats)
+
+    async def reset_handler(self, request: web.Request):
+        self.stats.clear()
+        return web.json_response({'ok': True})
+
+    async def handler(self, request: web.Request):
+        host = request.match_info['host']
+        url = f'https://{host}/{request.match_info["path"]}'
+        if request.query_string:
+            url += '?' + request.query_string
+        stats = self.stats[host]
+        stats['requests'] += 1
+
+        latency = self.args.latency_ms / 1000
+        await asyncio.sleep(random.uniform(0.5, 1.5) * latency)
+        if random.random() < self.args.timeout_rate:
+            stats['timeouts'] += 1
+            await asyncio.sleep(TIMEOUT_SLEEP)
+        if random.random() < self.args.error_rate:
+            stats['errors'] += 1
+            return web.Response(status=503, text='Service Unavailable')
+
+        if host == 'www.bike24.com':
+            challenge = await self.bike24_challenge(request, url, stats)
+            if challenge is not None:
+                return challenge
+
+        entry = self.exchanges.get((request.method, strip_lt(url)))
+        if entry is None:
+            stats['missing'] += 1
+            return web.Response(status=404, text='Not recorded')
+        store, exchange, body = entry
+
+        final_url = strip_lt(exchange['final_url'])
+        if final_url != strip_lt(url):
+            lt = request.query.get('lt')
+            location = f'http://{request.host}/' + final_url.split('://', 1)[1]
+            if lt is not None:
+                location += ('&' if '?' in location else '?') + 'lt=' + lt
+            raise web.HTTPFound(location)
+
+        if random.random() < self.args.price_flip_rate and store in PRICE_PATTERNS:
+            stats['price_flips'] += 1
+            factor = random.choice([0.8, 0.9, 1.1, 1.25])
+            body = PRICE_PATTERNS[store].sub(lambda m: scale_price(m, factor), body)
+        if random.random() < self.args.stock_flip_rate:
+            stats['stock_flips'] += 1
+            body = flip_stock(store, body)
+
+        content_type = 'application/json' if body.lstrip()[:1] in ('{', '[') else 'text/html'
+        return web.Response(status=exchange['status'], text=body, content_type=content_type)
+
+    async def bike24_challenge(self, request: web.Request, url: str, stats) -> web.Response | None:
+        path = urlsplit(url).path
+        if path == '/_sec/verify':
+            data = await request.json()
+            if self.challenges.pop(data.get('bm-verify'), None) != data.get('pow'):
+                return web.Response(status=403, text='Bad proof of work')
+            response = web.json_response({'reload': True})
+            response.set_cookie(CHALLENGE_COOKIE, str(int(time())))
+            return response
+
+        if not self.args.bike24_challenge or path.startswith('/api/'):
+            return None
+
+        issued = request.cookies.get(CHALLENGE_COOKIE)
+        if issued and int(issued) > time() - self.args.challenge_ttl:
+            return None
+
+        stats['challenges'] += 1
+        token = '%016x' % random.getrandbits(64)
+        pow_base = random.randint(1000, 9999)
+        pow_parts = [str(random.randint(10, 99)) for _ in range(3)]
+        self.challenges[token] = pow_base + int(''.join(pow_parts))
+        return web.Response(text=challenge_page(pow_base, pow_parts, token), content_type='text/html')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded store pages')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--store', action='append', dest='stores', help='limit to a store (repeatable)')
+    parser.add_argument('--latency-ms', type=float, default=200)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of 503 responses')
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help='share of requests that hang')
+    parser.add_argument('--price-flip-rate', type=float, default=0.0, help='share of pages with changed prices')
+    parser.add_argument('--stock-flip-rate', type=float, default=0.0, help='share of pages with flipped stock')
+    parser.add_argument('--no-bike24-challenge', action='store_false', dest='bike24_challenge')
+    parser.add_argument('--challenge-ttl', type=int, default=3600, help='seconds a solved challenge stays valid')
+    args = parser.parse_args()
+
+    server = ReplayServer(args)
+    print(f'Loaded {len(server.exchanges)} recorded responses')
+    web.run_app(server.app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+"""Regression check for the store parsers against the recorded fixtures.
+
+    python -m pytest app/bench/test_parsers.py
+"""
+import asyncio
+
+import pytest
+
+from bench_parsers import load_cases, normalize, parse_case
+from clients import STORE_CLIENTS
+from constants import STATUS_OK
+
+CASES = [(store, case_dir) for store, case_dirs in load_cases(None).items() for case_dir in case_dirs]
+
+
+def test_every_store_has_fixtures():
+    assert set(STORE_CLIENTS) <= {store for store, _ in CASES}
+
+
+@pytest.mark.parametrize('store,case_dir', CASES, ids=[f'{store}-{case_dir.name}' for store, case_dir in CASES])
+def test_parser_output_matches_fixture(store, case_dir):
+    case, result = asyncio.run(parse_case(store, case_dir))
+    assert result['status'] == STATUS_OK
+    assert normalize(result['variants']) == case['expected']
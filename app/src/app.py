@@ -2,14 +2,16 @@ import asyncio
 import logging
 import re
 from html import escape
-from hashlib import md5
 from datetime import datetime
-from time import time
+from hashlib import sha256
+from time import monotonic, time
 from collections import defaultdict
-from typing import AsyncIterator, Callable, Dict, Any, Awaitable
+from functools import partial
+from typing import Callable, Dict, Any, Awaitable
 
 from aiogram import Bot, Dispatcher, F, BaseMiddleware
 from aiogram.enums import ChatType, ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.filters import Command, CommandObject, CommandStart, BaseFilter
 from aiogram.client.default import DefaultBotProperties
 from aiogram.types import (
@@ -18,16 +20,25 @@ from aiogram.types import (
     InlineKeyboardMarkup,
     WebAppInfo
 )
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from pydantic import ValidationError
 from pytz import timezone
 from aiohttp import web
 from webapp.routes import list_handler, api_list_handler, api_delete_handler
 
-from config import PORT, WEBAPP_URL
+import clients
+import parsing
+from config import (
+    EMBEDDED_CRAWLER, PARSE_WORKERS, PORT, WEBAPP_URL, WEBHOOK_ENABLED, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_URL,
+    WORKER_ID
+)
+from crawler import Crawler
+from delivery import DeliveryEngine
+from leader import LeaderLock
 from database import close_database, db
-from models import Sku, User
-from repositories import ProductRepository, SettingsRepository, SkuRepository, UserRepository
+from models import Broadcast, ChangeEvent, Sku, User, Variant
+from repositories import BroadcastRepository, BulkWriter, OutboxRepository, PriceHistoryRepository, ProductRepository, ScheduleRepository, SettingsRepository, SkuRepository, UserRepository
 from settings import AppSettings
 
 settings: AppSettings
@@ -35,6 +46,29 @@ settings_repository = SettingsRepository(db)
 sku_repository = SkuRepository(db)
 product_repository = ProductRepository(db)
 user_repository = UserRepository(db)
+broadcast_repository = BroadcastRepository(db)
+outbox_repository = OutboxRepository(db)
+schedule_repository = ScheduleRepository(db)
+price_history_repository = PriceHistoryRepository(db)
+crawler = Crawler()
+delivery = DeliveryEngine()
+background_tasks = set()
+running_broadcasts = set()
+crawl_tasks: dict[str, asyncio.Task] = {}
+outbox_ready = asyncio.Event()
+
+OUTBOX_BATCH_SIZE = 2000
+OUTBOX_POLL_INTERVAL = 10
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_DELAY = 60
+OUTBOX_SEND_CHUNK = 100
+CHECK_BATCH_SIZE = 5000
+CLAIM_BATCH_SIZE = 200
+LEASE_SECONDS = 300
+HISTORY_DAYS = 90
+LEADER_TTL = 15
+
+leader = LeaderLock(db.leader, 'bot', WORKER_ID, LEADER_TTL)
 
 
 class IsAdmin(BaseFilter):
@@ -55,7 +89,15 @@ async def load_settings():
     )
     ProductRepository.configure(
         cache_lifetime=settings.cache_lifetime,
-        http_timeout=settings.http_timeout
+        http_timeout=settings.http_timeout,
+        retention=settings.max_check_interval * 2
+    )
+    crawler.configure(
+        stores=settings.stores,
+        request_delay=settings.request_delay,
+        http_timeout=settings.http_timeout,
+        check_interval=settings.check_interval,
+        max_check_interval=settings.max_check_interval
     )
 
 
@@ -101,10 +143,18 @@ dp.message.middleware(LoggingMiddleware())
 
 async def processException(e: Exception, chat_id: str):
     error_codes = ['bot was blocked', 'user is deactivated']
-    if e.message and any(code in e.message for code in error_codes):
+    message = getattr(e, 'message', None)
+    if message and any(code in message for code in error_codes):
         await disableUser(chat_id)
 
 
+def isPermanentError(e: Exception) -> bool:
+    # Blocked, deactivated or deleted chats never accept the message, retrying only delays the cleanup
+    if isinstance(e, TelegramForbiddenError):
+        return True
+    return isinstance(e, TelegramBadRequest) and 'chat not found' in e.message
+
+
 @dp.message(CommandStart(), F.chat.type == ChatType.PRIVATE)
 async def processCmdStart(message: Message):
     await message.answer(settings.banner_start)
@@ -112,47 +162,105 @@ async def processCmdStart(message: Message):
     user = User.from_aiogram_user(message.from_user)
     await user_repository.save(user)
     await sku_repository.update_many({'chat_id': user.id}, {'$set': {'enable': True}})
+    await schedule_repository.wake(await sku_repository.distinct('store_prodid', {'chat_id': user.id}), int(time()))
 
 
-async def broadcast(message: Message, text, users: AsyncIterator[User], pin=False):
-    text_hash = md5(text.encode('utf-8')).hexdigest()
-    await message.answer('🟢 Начало рассылки')
+def broadcastRequests(job: Broadcast, chat_id: str) -> list[Callable[[], Awaitable]]:
+    sent = {}
 
-    count = 0
-    async for user in users:
-        count += 1
-        if count % 100 == 0:
-            await message.answer('Обработано: ' + str(count))
-                
-        if text_hash in user.broadcasts:
-            continue
+    async def send():
+        sent['message'] = await bot.send_message(chat_id=chat_id, text=job.text)
 
-        try:
-            sent_message = await bot.send_message(chat_id=user.id, text=text)
-            if pin:
-                await bot.pin_chat_message(chat_id=user.id, message_id=sent_message.message_id)            
-            user.broadcasts.append(text_hash)
-            await user_repository.save(user)
-        except Exception as e:
-            await processException(e, user.id)
-        await asyncio.sleep(0.1)
+    async def pin():
+        await bot.pin_chat_message(chat_id=chat_id, message_id=sent['message'].message_id)
+
+    return [send, pin] if job.pin else [send]
 
-    await message.answer('🔴 Окончание рассылки')
+
+async def updateBroadcastProgress(job: Broadcast):
+    try:
+        await bot.edit_message_text(
+            text=job.get_progress_string(),
+            chat_id=job.chat_id,
+            message_id=job.progress_message_id
+        )
+    except Exception as e:
+        logging.warning(f'Broadcast progress update failed: {e}')
+
+
+async def runBroadcast(job: Broadcast):
+    while True:
+        if not await leader.verify():
+            # The next leader resumes the job from its last checkpoint
+            return
+        token = leader.token
+        user_ids = await user_repository.find_ids(job.audience, job.last_user_id)
+        if not user_ids:
+            break
+
+        deliveries = [(chat_id, await delivery.submit(chat_id, *broadcastRequests(job, chat_id))) for chat_id in user_ids]
+        results = await asyncio.gather(*(future for _, future in deliveries), return_exceptions=True)
+
+        async with user_repository.bulk_writer() as writer:
+            for (chat_id, _), result in zip(deliveries, results):
+                if isinstance(result, Exception):
+                    job.failed += 1
+                    await processException(result, chat_id)
+                else:
+                    job.sent += 1
+                    await writer.add(user_repository.broadcast_request(chat_id, job.hash), chat_id)
+
+        job.last_user_id = user_ids[-1]
+        if not await broadcast_repository.save(job, token):
+            logging.warning(f'Broadcast {job.doc_id} was taken over by a newer leader')
+            return
+        await updateBroadcastProgress(job)
+
+    job.status = 'done'
+    if await broadcast_repository.save(job, token):
+        await updateBroadcastProgress(job)
+
+
+def startBroadcast(job: Broadcast):
+    if job.doc_id in running_broadcasts:
+        return
+    task = asyncio.create_task(runBroadcast(job))
+    background_tasks.add(task)
+    running_broadcasts.add(job.doc_id)
+    task.add_done_callback(background_tasks.discard)
+    task.add_done_callback(lambda _: running_broadcasts.discard(job.doc_id))
+
+
+async def resumeBroadcasts():
+    async for job in broadcast_repository.find_running():
+        if job.doc_id not in running_broadcasts:
+            logging.warning(f'Resuming broadcast {job.doc_id} after {job.last_user_id}')
+            startBroadcast(job)
+
+
+async def broadcast(message: Message, text, store=None, pin=False):
+    job = Broadcast(text=text, pin=pin, store=store, chat_id=str(message.chat.id))
+    progress_message = await message.answer(job.get_progress_string())
+    job.progress_message_id = progress_message.message_id
+    await broadcast_repository.insert(job)
+    # With webhooks the command may land on a follower, the leader picks the job up within a minute
+    if leader.is_leader:
+        startBroadcast(job)
 
 
 @dp.message(Command('users'), IsAdmin())
 async def processCmdUpdateUsers(message: Message):
     await message.answer('🟢 Начало обновления списка пользователей')
     count = 0
-    async for user in user_repository.find({'enable': True}):
+    async for user in user_repository.find_rows({'enable': True}, ('_id',)):
         count += 1
         if count % 100 == 0:
             await message.answer('Обработано: ' + str(count))
         
         try:
-            await bot.send_chat_action(chat_id=user.id, action='typing')
+            await bot.send_chat_action(chat_id=user.doc_id, action='typing')
         except Exception as e:
-            await processException(e, user.id)
+            await processException(e, user.doc_id)
         await asyncio.sleep(0.1)
 
     await message.answer('🔴 Окончание обновления списка пользователей')
@@ -164,8 +272,7 @@ async def processCmdBroadcast(message: Message, command: CommandObject):
     if not text:
         await message.answer('Empty broadcast text')
         return
-    users = user_repository.find({'enable': True})
-    await broadcast(message, text, users)
+    await broadcast(message, text)
 
 
 @dp.message(Command('bc_pin'), IsAdmin())
@@ -174,8 +281,7 @@ async def processCmdBroadcastAndPin(message: Message, command: CommandObject):
     if not text:
         await message.answer('Empty broadcast text')
         return
-    users = user_repository.find({'enable': True})
-    await broadcast(message, text, users, pin=True)
+    await broadcast(message, text, pin=True)
 
 
 @dp.message(Command(re.compile(r'^bc_(\w+)$')), IsAdmin())
@@ -185,8 +291,7 @@ async def processCmdBroadcastByStore(message: Message, command: CommandObject):
     if not text:
         await message.answer('Empty broadcast text')
         return
-    users = user_repository.find_by_store(store)
-    await broadcast(message, text, users)
+    await broadcast(message, text, store=store)
 
 
 @dp.message(Command('reload'), IsAdmin())
@@ -201,9 +306,56 @@ async def cmd_reload(message: Message):
         await paginatedTgMsg(errors, message.chat.id)
         return
 
+    await product_repository.ensure_indexes()
     await message.answer('Settings successfully reloaded')
 
 
+async def ensureIndexes():
+    missing = []
+    missing += await sku_repository.ensure_indexes()
+    missing += await product_repository.ensure_indexes()
+    missing += await user_repository.ensure_indexes()
+    missing += await broadcast_repository.ensure_indexes()
+    missing += await outbox_repository.ensure_indexes()
+    missing += await schedule_repository.ensure_indexes()
+    missing += await price_history_repository.ensure_indexes()
+    if missing:
+        raise RuntimeError('Missing indexes: ' + ', '.join(missing))
+
+
+async def migrate():
+    # Drops and backfills, run by the leader only
+    for step in (sku_repository.migrate, product_repository.migrate):
+        if not await leader.verify():
+            raise RuntimeError('Lost leadership before migration')
+        await step()
+
+
+@dp.message(Command('explain'), IsAdmin())
+async def processCmdExplain(message: Message):
+    now = int(time())
+    chat_id = str(message.from_user.id)
+    queries = [
+        ('sku by chat_id', sku_repository, {'chat_id': chat_id}, None),
+        ('sku search', sku_repository, {'chat_id': chat_id, 'name': {'$regex': 'a'}}, None),
+        ('schedule due', schedule_repository, {'next_check_at': {'$lte': now}, 'store': {'$in': list(settings.stores)}}, 'next_check_at'),
+        ('sku by store_prodid', sku_repository, {'store_prodid': {'$in': ['']}, 'enable': True}, 'store_prodid'),
+        ('sku checked recently', sku_repository, {'lastcheckts': {'$gt': now - settings.check_interval * 60}}, None),
+        ('sku invalid', sku_repository, {'lastgoodts': {'$lt': now - settings.error_max_days * 24 * 3600}}, None),
+        ('sku by store', sku_repository, {'store': next(iter(settings.stores), '')}, None),
+        ('skucache by url', product_repository, {'url': '', 'timestamp': {'$gt': now}}, None),
+        ('skucache by id', product_repository, {'_id': ''}, None),
+        ('users enabled', user_repository, {'enable': True}, None),
+        ('outbox by chat', outbox_repository, {'chat_id': chat_id}, '_id'),
+    ]
+
+    lines = []
+    for name, repository, query, sort in queries:
+        plan = await repository.explain(query, sort)
+        lines.append(f'<b>{escape(name)}:</b> <code>{escape(plan)}</code>')
+    await paginatedTgMsg(lines, message.chat.id)
+
+
 @dp.message(F.text.regexp(r'https?://', mode='search'), F.chat.type == ChatType.PRIVATE)
 async def processURLMsg(message: Message):
     for store in settings.stores.values():
@@ -288,6 +440,18 @@ async def processCmdDel(message: Message):
     await message.answer('Какая-то ошибка 😧')
 
 
+@dp.message(F.text.regexp(r'^/history_\w+_\w+_\w+$'), F.chat.type == ChatType.PRIVATE)
+async def processCmdHistory(message: Message):
+    params = message.text.split('_')
+    store = params[1].upper()
+    prodid = params[2]
+    skuid = params[3]
+    now = int(time())
+    start = now - HISTORY_DAYS * 24 * 3600
+    history = await price_history_repository.get(store, prodid, skuid, start)
+    await paginatedTgMsg(history.get_string(start, now), message.chat.id)
+
+
 @dp.message(Command('help'), F.chat.type == ChatType.PRIVATE)
 async def processCmdHelp(message: Message):
     await message.answer(settings.banner_help)
@@ -344,6 +508,14 @@ async def processCmdStat(message: Message):
     msg += f'<b>Active SKU:</b> {skuactive}\n'
     msg += f'<b>Unique active URLs:</b> {unique_urls}\n'
 
+    cache = product_repository.memory
+    msg += f'<b>Product cache:</b> {len(cache)} items, {cache.bytes // 1024} KB, hits {cache.hits}, misses {cache.misses}, unchanged pages {product_repository.unchanged}\n'
+    msg += f'<b>Outbox:</b> {await outbox_repository.count()} events\n'
+    for store, controller in crawler.controllers.items():
+        msg += f'<b>{store}:</b> {controller.get_string()}\n'
+    msg += f'<b>Due for check:</b> {await schedule_repository.count_due(int(time()))} products, '
+    msg += f'{await schedule_repository.count_leased(int(time()))} leased\n'
+
     for key in settings.stores.keys():
         num = await sku_repository.count({'store': key})
         msg += f'<b>{key}:</b> {num}\n'
@@ -410,8 +582,7 @@ async def addVariant(store, prodid, skuid, message: Message):
         await reply_or_edit_msg('Какая-то ошибка 😧', message)
         return
     
-    query = {'chat_id': user.id}
-    if await sku_repository.count(query) >= user.max_items:
+    if user.sku_count >= user.max_items:
         await reply_or_edit_msg(f'⛔️ Увы, в данный момент добавить можно не более {user.max_items} позиций', message)
         return
 
@@ -432,28 +603,41 @@ async def addVariant(store, prodid, skuid, message: Message):
 
     sku = Sku.from_variant(prod.variants[skuid], user.id)
     await sku_repository.insert(sku)
+    await price_history_repository.record(sku, int(time()))
     await reply_or_edit_msg(f'{sku.variant or sku.name}\n✔️ Добавлено к отслеживанию', message)
 
 
-async def paginatedTgMsg(text_array, chat_id, message_id=0, delimiter='\n\n'):
-    async def sendOrEditMsg():
-        if message_id != 0 and first_page:
-            await bot.edit_message_text(text=msg, chat_id=chat_id, message_id=message_id)
-        else:
-            await bot.send_message(chat_id, msg)
-
-    first_page = True
+def paginate(text_array, delimiter='\n\n') -> list[str]:
+    pages = []
     msg = ''
-
     for paragraph in text_array:
         if len(msg + paragraph) > 4090:
-            await sendOrEditMsg()
+            pages.append(msg)
             msg = ''
-            first_page = False
         msg += paragraph + delimiter
 
     if msg:
-        await sendOrEditMsg()
+        pages.append(msg)
+    return pages
+
+
+def pageRequests(text_array, chat_id) -> list[Callable[[], Awaitable]]:
+    return [partial(bot.send_message, chat_id, page) for page in paginate(text_array)]
+
+
+async def paginatedTgMsg(text_array, chat_id, message_id=0, delimiter='\n\n'):
+    for i, msg in enumerate(paginate(text_array, delimiter)):
+        if message_id != 0 and i == 0:
+            await bot.edit_message_text(text=msg, chat_id=chat_id, message_id=message_id)
+        else:
+            await bot.send_message(chat_id, msg)
+
+
+async def awaitDeliveries(deliveries):
+    results = await asyncio.gather(*(future for _, future in deliveries), return_exceptions=True)
+    for (chat_id, _), result in zip(deliveries, results):
+        if isinstance(result, Exception):
+            await processException(result, chat_id)
 
 
 async def removeInvalidSKU():
@@ -461,76 +645,86 @@ async def removeInvalidSKU():
     tsexpired = int(time()) - settings.error_max_days * 24 * 3600
     query = {'lastgoodts': {'$lt': tsexpired}}
     messages = {}
-    async for sku in sku_repository.find(query):
-        user = await user_repository.find_one(sku.chat_id)
-        if not user.enable:
-            continue
-        line = sku.get_string('store', 'url')
-        messages.setdefault(sku.chat_id, [banner]).append(line)
+    async for row in sku_repository.find_rows(query, ('chat_id', *Variant.FIELDS)):
+        messages.setdefault(row.chat_id, [banner]).append(Variant(row._asdict()).get_string('store', 'url'))
 
     await sku_repository.delete_many(query)
+    enabled = {row.doc_id async for row in user_repository.find_rows({'_id': {'$in': list(messages)}, 'enable': True}, ('_id',))}
+    messages = {chat_id: message for chat_id, message in messages.items() if chat_id in enabled}
 
+    deliveries = []
     for chat_id, message in messages.items():
-        try:
-            await paginatedTgMsg(message, chat_id)
-        except Exception as e:
-            await processException(e, chat_id)
-        await asyncio.sleep(0.1)
+        deliveries.append((chat_id, await delivery.submit(chat_id, *pageRequests(message, chat_id))))
+    await awaitDeliveries(deliveries)
 
 
-async def notify():
-    def addMsg(msg):
-        messages.setdefault(sku.chat_id, []).append(msg)
+def isUserChat(chat_id) -> bool:
+    service_chats = (settings.best_deals_chat_id, settings.log_chat_id, settings.admin_chat_id)
+    return str(chat_id) not in {str(service_chat) for service_chat in service_chats if service_chat}
 
-    def processBestDeals():
-        price_prev = sku.price_prev
-        price = sku.price
-        if price_prev == 0:
-            return
-        percents = int((1 - price/float(price_prev))*100)
-        value = price_prev - price
-        minvalue = settings.best_deals_min_value.get(sku.currency, 0)
-        if percents >= settings.best_deals_min_percentage and value >= minvalue:
-            bdkey = sku.store_prodid + '_' + sku.id
-            bestdeals[bdkey] = skustring + ' ' + str(percents) + '%'
-            if percents >= settings.best_deals_warn_percentage:
-                bestdeals[bdkey] += '‼️'
 
-    messages = {}
-    bestdeals = {}
-    notification_sku_ids = []
+async def drainOutbox(token: int) -> int:
+    batch = list((await outbox_repository.next_batch(OUTBOX_BATCH_SIZE, token)).items())
+    delivered = 0
+    # Only a chunk of chats is in flight at once, and leadership is re-checked before every chunk
+    for start in range(0, len(batch), OUTBOX_SEND_CHUNK):
+        if start and not (await leader.verify() and leader.token == token):
+            # The rest stays stamped with the old token until the next leader claims it
+            break
+        delivered += await deliverOutboxChunk(batch[start:start + OUTBOX_SEND_CHUNK], token)
+    return delivered
 
-    query = {'$or': [{'price_prev': {'$ne': None}},{'instock_prev': {'$ne': None}}], 'enable': True}
-    async for sku in sku_repository.find(query):
-        if sku.instock_prev is not None:
-            skustring = sku.get_string('store', 'url', 'price')
-            if sku.instock:
-                addMsg('✅ Снова в наличии!\n' + skustring)
-            if not sku.instock:
-                addMsg('🚫 Не в наличии\n' + skustring)
-        elif sku.price_prev is not None and sku.instock:
-            skustring = sku.get_string('store', 'url', 'price', 'price_prev')
-            if sku.price < sku.price_prev:
-                addMsg('📉 Снижение цены!\n' + skustring)
-                processBestDeals()
-            if sku.price > sku.price_prev:
-                addMsg('📈 Повышение цены\n' + skustring)
-
-        notification_sku_ids.append(sku.doc_id)
 
-    for chat_id, message in messages.items():
+async def deliverOutboxChunk(chunk: list[tuple[str, list[ChangeEvent]]], token: int) -> int:
+    deliveries = []
+    copies = []
+    for chat_id, events in chunk:
+        lines = [event.get_message() for event in events]
+        deliveries.append((chat_id, events, await delivery.submit(chat_id, *pageRequests(lines, chat_id))))
+        if settings.debug and settings.log_chat_id and chat_id != settings.best_deals_chat_id:
+            copies.append(await delivery.submit(settings.log_chat_id, *pageRequests(lines, settings.log_chat_id)))
+
+    delivered = 0
+    for chat_id, events, future in deliveries:
         try:
-            await paginatedTgMsg(message, chat_id)
+            await future
         except Exception as e:
-            await processException(e, chat_id)
-        if settings.debug and settings.log_chat_id:
-            await paginatedTgMsg(message, settings.log_chat_id)
-        await asyncio.sleep(0.1)
+            attempts = max(event.attempts for event in events) + 1
+            if not isPermanentError(e) and attempts < OUTBOX_MAX_ATTEMPTS:
+                await outbox_repository.retry(events, int(time()) + OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), token)
+                continue
+            logging.error(f'Dropping {len(events)} notifications for chat {chat_id}: {e}')
+            if isUserChat(chat_id):
+                await processException(e, chat_id)
+        await outbox_repository.ack(events, token)
+        delivered += len(events)
+
+    for result in await asyncio.gather(*copies, return_exceptions=True):
+        if isinstance(result, Exception):
+            logging.warning(f'Debug copy to the log chat failed: {result}')
+    return delivered
+
+
+async def deliverOutbox():
+    while True:
+        try:
+            delivered = await drainOutbox(leader.token) if await leader.verify() else 0
+        except Exception as e:
+            logging.exception(f'Outbox delivery failed: {e}')
+            delivered = 0
+
+        if not delivered:
+            outbox_ready.clear()
+            try:
+                await asyncio.wait_for(outbox_ready.wait(), OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
 
-    if settings.best_deals_chat_id:
-        await paginatedTgMsg(bestdeals.values(), settings.best_deals_chat_id)
 
-    await sku_repository.clear_notifications(notification_sku_ids)
+async def reconcileCounters():
+    repaired = await user_repository.reconcile_counters()
+    if repaired:
+        logging.warning(f'Repaired SKU counters of {repaired} users')
 
 
 async def disableUser(chat_id):
@@ -539,33 +733,159 @@ async def disableUser(chat_id):
 
 
 async def checkSKU():
+    startCrawls()
+
+
+def crawlableStores() -> list[str]:
+    return [name for name, store in settings.stores.items() if store.active and crawler.available(name)]
+
+
+def startCrawls() -> int:
+    # Every store claims and crawls on its own, a slow store never holds up the others
+    started = 0
+    for store in crawlableStores():
+        task = crawl_tasks.get(store)
+        if task is None or task.done():
+            crawl_tasks[store] = asyncio.create_task(crawlStore(store))
+            started += 1
+    return started
+
+
+async def stopCrawls():
+    tasks = list(crawl_tasks.values())
+    crawl_tasks.clear()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def crawlStore(store: str, limit: int = CHECK_BATCH_SIZE) -> int:
+    checked = 0
+    while checked < limit and store in crawlableStores():
+        try:
+            claimed = await crawlBatch(store)
+        except Exception as e:
+            logging.exception(f'{store} crawl batch failed: {e}')
+            break
+        if not claimed:
+            break
+        checked += claimed
+    return checked
+
+
+async def renewLeases(store_prodids: list[str]):
+    while True:
+        await asyncio.sleep(LEASE_SECONDS / 3)
+        try:
+            await schedule_repository.renew(store_prodids, WORKER_ID, int(time()) + LEASE_SECONDS)
+        except Exception as e:
+            logging.warning(f'Lease renewal failed: {e}')
+
+
+async def crawlBatch(store: str) -> int:
     now = int(time())
-    query = {'enable': True, 'lastcheckts': {'$lt': now - settings.check_interval * 60}}
-    prodlist = set()
-    async for sku in sku_repository.find(query):
-        prodlist.add(sku.store_prodid)
-    
-    prodlist = list(prodlist)
-    if not prodlist:
-        return
+    due = await schedule_repository.claim(WORKER_ID, now, [store], LEASE_SECONDS, CLAIM_BATCH_SIZE)
+    if not due:
+        return 0
 
-    query = {'store_prodid': {'$in': prodlist}, 'enable': True}
-    async for sku in sku_repository.find(query, sort='store_prodid'):
-        store = settings.stores[sku.store]
-        if not store.active:
-            continue
+    renewal = asyncio.create_task(renewLeases(list(due)))
+    try:
+        jobs = defaultdict(list)
+        query = {'store_prodid': {'$in': list(due)}, 'enable': True}
+        async for sku in sku_repository.find(query, sort='store_prodid'):
+            store_jobs = jobs[sku.store]
+            if store_jobs and store_jobs[-1][0].store_prodid == sku.store_prodid:
+                store_jobs[-1].append(sku)
+            else:
+                store_jobs.append([sku])
+
+        found = {skus[0].store_prodid for store_jobs in jobs.values() for skus in store_jobs}
+        await schedule_repository.delete_many([store_prodid for store_prodid in due if store_prodid not in found], WORKER_ID)
+
+        async with (
+            sku_repository.bulk_writer() as writer,
+            outbox_repository.bulk_writer() as outbox,
+            schedule_repository.bulk_writer() as schedule,
+            price_history_repository.bulk_writer() as history,
+            user_repository.bulk_writer() as users
+        ):
+            handler = partial(
+                checkProduct, writer=writer, outbox=outbox, schedule=schedule, history=history, users=users, entries=due
+            )
+            await crawler.run(jobs, handler)
+    finally:
+        renewal.cancel()
+        # Products skipped by an open circuit or a failed job become claimable again
+        await schedule_repository.release(list(due), WORKER_ID)
+
+    outbox_ready.set()
+    return len(due)
+
+
+async def syncSchedule():
+    changed = await schedule_repository.sync()
+    if changed:
+        logging.warning(f'Synced {changed} check schedule entries')
+
+
+def bestDeal(sku: Sku, price_prev: int) -> ChangeEvent | None:
+    if price_prev == 0:
+        return None
+    percents = int((1 - sku.price/float(price_prev))*100)
+    value = price_prev - sku.price
+    minvalue = settings.best_deals_min_value.get(sku.currency, 0)
+    if percents < settings.best_deals_min_percentage or value < minvalue:
+        return None
+    return ChangeEvent.from_sku(
+        sku,
+        settings.best_deals_chat_id,
+        'deal',
+        price_prev,
+        percents=percents,
+        warn=percents >= settings.best_deals_warn_percentage
+    )
 
-        logging.info(sku.doc_id + ' [' + sku.name + '][' + sku.variant + ']')
 
-        prod = await product_repository.get(sku.store, sku.url)
+async def checkProduct(
+    skus: list[Sku],
+    writer: BulkWriter,
+    outbox: BulkWriter,
+    schedule: BulkWriter,
+    history: BulkWriter,
+    users: BulkWriter,
+    entries: dict[str, dict]
+) -> bool:
+    first = skus[0]
+    store = settings.stores[first.store]
+    logging.info(first.store_prodid + ' [' + first.name + '] subscribers: ' + str(len(skus)))
+
+    started = monotonic()
+    prod = await product_repository.get(first.store, first.url)
+    if prod.source == 'web' and crawler.record(first.store, prod.status, monotonic() - started):
+        try:
+            await bot.send_message(
+                settings.admin_chat_id,
+                f'Circuit opened for {first.store}!\n{crawler.controllers[first.store].get_string()}'
+            )
+        except Exception as e:
+            logging.error(f'Circuit alert failed: {e}')
+    deals = {}
+    recorded = set()
+    changed = False
+    for sku in skus:
         if prod.has_sku(sku.id):
             variant = prod.variants[sku.id]
-            if variant.instock != sku.instock:
-                sku.instock_prev = sku.instock
-            
+            if sku.id not in recorded and (variant.price != sku.price or variant.instock != sku.instock):
+                recorded.add(sku.id)
+                await history.add(price_history_repository.record_request(variant, int(time())), variant.key)
+            instock_changed = variant.instock != sku.instock
+            if instock_changed or (variant.price, variant.currency, variant.variant) != (sku.price, sku.currency, sku.variant):
+                # Invalidates the web app list ETag
+                await users.add(user_repository.touch_request(sku.chat_id), sku.chat_id)
+            price_prev = None
             if variant.currency == sku.currency:
                 if sku.price * store.price_threshold < abs(variant.price - sku.price):
-                    sku.price_prev = sku.price
+                    price_prev = sku.price
 
             sku.instock = variant.instock
             sku.currency = variant.currency
@@ -573,17 +893,37 @@ async def checkSKU():
             sku.variant = variant.variant
             sku.errors = 0
             sku.lastgoodts = int(time())
+
+            event = None
+            if instock_changed:
+                event = ChangeEvent.from_sku(sku, sku.chat_id, 'instock' if sku.instock else 'outofstock')
+            elif price_prev is not None and sku.instock:
+                event = ChangeEvent.from_sku(sku, sku.chat_id, 'price_down' if sku.price < price_prev else 'price_up', price_prev)
+                if sku.price < price_prev and settings.best_deals_chat_id and sku.id not in deals:
+                    deals[sku.id] = bestDeal(sku, price_prev)
+            if event:
+                changed = True
+                await outbox.add(outbox_repository.insert_request(event), sku.doc_id)
         else:
             sku.errors += 1
 
         sku.lastcheck = datetime.now(timezone('Asia/Yekaterinburg')).strftime('%d.%m.%Y %H:%M')
         sku.lastcheckts = int(time())
-        try:
-            await sku_repository.save(sku)
-        except Exception as e:
-            logging.error(f'Error updating SKU: {e}')
-        if prod.source == 'web':
-            await asyncio.sleep(settings.request_delay)
+        await writer.add(sku_repository.save_request(sku), sku.doc_id)
+
+    for deal in deals.values():
+        if deal:
+            await outbox.add(outbox_repository.insert_request(deal), deal.key)
+
+    now = int(time())
+    entry = entries[first.store_prodid]
+    change_rate = crawler.policy.change_rate(entry['change_rate'], changed)
+    next_check_at = crawler.next_check_at(first.store, now, change_rate, len(skus))
+    await schedule.add(
+        schedule_repository.reschedule_request(first.store_prodid, WORKER_ID, now, next_check_at, change_rate, len(skus)),
+        first.store_prodid
+    )
+    return prod.source == 'web'
 
 
 async def errorsMonitor():
@@ -591,11 +931,11 @@ async def errorsMonitor():
     good = defaultdict(int)
     query = {'lastcheckts': {'$gt': int(time()) - settings.check_interval * 60}}
     
-    async for sku in sku_repository.find(query):
-        if sku.errors == 0:
-            good[sku.store] += 1
+    async for row in sku_repository.find_rows(query, ('store', 'errors')):
+        if row.errors == 0:
+            good[row.store] += 1
         else:
-            bad[sku.store] += 1
+            bad[row.store] += 1
 
     for store in set(list(good) + list(bad)):
         if not settings.stores[store].active:
@@ -619,18 +959,88 @@ def create_webapp_server():
     return app
 
 
+def webhookSecret() -> str:
+    # Telegram echoes it in X-Telegram-Bot-Api-Secret-Token, derived from the token unless configured
+    return WEBHOOK_SECRET or sha256(settings.token.encode('utf-8')).hexdigest()
+
+
+def createBot() -> Bot:
+    botProperties = DefaultBotProperties(parse_mode=ParseMode.HTML, link_preview_is_disabled=True)
+    return Bot(token=settings.token, default=botProperties)
+
+
+def leaderOnly(job):
+    async def wrapper():
+        if await leader.verify():
+            await job()
+    wrapper.__name__ = job.__name__
+    return wrapper
+
+
+async def lead():
+    while True:
+        await leader.elected.wait()
+        tasks = []
+        try:
+            await migrate()
+            await reconcileCounters()
+            await syncSchedule()
+            await resumeBroadcasts()
+            tasks.append(asyncio.create_task(deliverOutbox()))
+            if WEBHOOK_ENABLED:
+                await bot.set_webhook(
+                    WEBHOOK_URL,
+                    secret_token=webhookSecret(),
+                    allowed_updates=dp.resolve_used_update_types()
+                )
+            else:
+                await bot.delete_webhook()
+                tasks.append(asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False)))
+        except Exception as e:
+            logging.exception(f'Leader setup failed, stepping down: {e}')
+            await leader.resign()
+        else:
+            lost = asyncio.create_task(leader.lost.wait())
+            await asyncio.wait([lost, *tasks], return_when=asyncio.FIRST_COMPLETED)
+
+            if not lost.done():
+                # Polling or outbox delivery died, hand leadership to another replica
+                logging.error('Leader task stopped unexpectedly, stepping down')
+                await leader.resign()
+            lost.cancel()
+
+        try:
+            await dp.stop_polling()
+        except RuntimeError:
+            pass
+        running = tasks + list(background_tasks)
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+
 async def main():
     # settings
     await load_settings()
+    await ensureIndexes()
 
     # Initialize bot and dispatcher
     global bot
-    botProperties = DefaultBotProperties(parse_mode=ParseMode.HTML, link_preview_is_disabled=True)
-    bot = Bot(token=settings.token, default=botProperties)
+    bot = createBot()
+
+    await clients.registry.open()
+    delivery.start()
+    if PARSE_WORKERS:
+        parsing.start_parse_pool(PARSE_WORKERS)
 
     web_app = create_webapp_server()
     web_app['bot'] = bot
     web_app['sku_repository'] = sku_repository
+    web_app['user_repository'] = user_repository
+    if WEBHOOK_ENABLED:
+        # Every replica accepts updates, only the leader registers the webhook
+        SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=webhookSecret()).register(web_app, path=WEBHOOK_PATH)
+        setup_application(web_app, dp, bot=bot)
     web_runner = web.AppRunner(web_app)
     await web_runner.setup()
     site = web.TCPSite(web_runner, '0.0.0.0', PORT)
@@ -639,17 +1049,27 @@ async def main():
     scheduler = AsyncIOScheduler(job_defaults={'misfire_grace_time': None})
     scheduler.start()
 
-    scheduler.add_job(checkSKU, 'interval', minutes=5)
-    scheduler.add_job(notify, 'interval', minutes=5)
-    scheduler.add_job(errorsMonitor, 'interval', minutes=settings.check_interval)
-    scheduler.add_job(product_repository.clear_sku_cache, 'cron', day_of_week='mon', hour=0, minute=0)
-    scheduler.add_job(removeInvalidSKU, 'cron', day=1, hour=14, minute=0)
+    # Leases let every replica crawl, everything else runs on the leader only
+    if EMBEDDED_CRAWLER:
+        scheduler.add_job(checkSKU, 'interval', minutes=5)
+    scheduler.add_job(leaderOnly(errorsMonitor), 'interval', minutes=settings.check_interval)
+    scheduler.add_job(leaderOnly(removeInvalidSKU), 'cron', day=1, hour=14, minute=0)
+    scheduler.add_job(leaderOnly(reconcileCounters), 'cron', hour=4, minute=0)
+    scheduler.add_job(leaderOnly(syncSchedule), 'cron', hour=4, minute=30)
+    scheduler.add_job(leaderOnly(resumeBroadcasts), 'interval', minutes=1)
 
+    leader.start()
     try:
-        await dp.start_polling(bot)
+        await lead()
     finally:
         scheduler.shutdown()
+        await stopCrawls()
+        await leader.stop()
         await web_runner.cleanup()
+        await delivery.stop()
+        await clients.registry.close()
+        await bot.session.close()
+        parsing.stop_parse_pool()
         await close_database()
 
 
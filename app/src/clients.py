@@ -0,0 +1,174 @@
+import asyncio
+import json
+from typing import Any, Mapping
+from urllib.parse import urlsplit
+
+from aiohttp import ClientSession, ClientTimeout, DummyCookieJar, TCPConnector
+from curl_cffi import CurlHttpVersion, CurlOpt
+from curl_cffi import requests as curl
+from curl_cffi.requests.exceptions import Timeout as CurlTimeout
+
+from config import STORE_HOST_OVERRIDE
+
+DNS_CACHE_TTL = 300
+CONNECTIONS_PER_HOST = 8
+KEEPALIVE_TIMEOUT = 60
+
+STORE_CLIENTS = {
+    'SB': {'backend': 'curl', 'impersonate': 'safari15_5'},
+    'BD': {'backend': 'curl', 'impersonate': 'safari15_5'},
+    'B24': {'backend': 'curl', 'impersonate': 'firefox'},
+    'TI': {'backend': 'aiohttp'},
+    'BC': {'backend': 'aiohttp'},
+    'CRC': {'backend': 'aiohttp'},
+    'A4C': {'backend': 'aiohttp'},
+    'LG': {'backend': 'aiohttp'},
+}
+
+
+class HTTPStatusError(Exception):
+    pass
+
+
+class Response:
+    def __init__(self, status: int, url: str, text: str, headers: Mapping[str, str], cookies: dict[str, str]):
+        self.status = status
+        self.url = url
+        self.text = text
+        self.headers = headers
+        self.cookies = cookies
+
+    def json(self) -> Any:
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise HTTPStatusError(f'HTTP {self.status} for {self.url}')
+
+
+class ClientRegistry:
+    def __init__(self, host_override: str = ''):
+        self.sessions: dict[str, ClientSession | curl.AsyncSession] = {}
+        # Send every store request to a stand-in server as http://override/<host>/<path>
+        self.host_override = host_override.rstrip('/')
+
+    async def open(self, stores=STORE_CLIENTS):
+        for store in stores:
+            self._session(store)
+
+    async def close(self):
+        sessions, self.sessions = self.sessions, {}
+        for session in sessions.values():
+            await session.close()
+
+    async def get(self, store: str, url: str, timeout: int, **kwargs) -> Response:
+        return await self.request(store, 'GET', url, timeout, **kwargs)
+
+    async def post(self, store: str, url: str, timeout: int, **kwargs) -> Response:
+        return await self.request(store, 'POST', url, timeout, **kwargs)
+
+    async def request(
+        self,
+        store: str,
+        method: str,
+        url: str,
+        timeout: int,
+        headers: dict | None = None,
+        cookies: dict | None = None,
+        json: Any = None
+    ) -> Response:
+        session = self._session(store)
+        url = self._route(url)
+        if isinstance(session, ClientSession):
+            response = await self._aiohttp_request(session, method, url, timeout, headers, cookies, json)
+        else:
+            response = await self._curl_request(session, method, url, timeout, headers, cookies, json)
+        response.url = self._unroute(response.url)
+        return response
+
+    def _route(self, url: str) -> str:
+        if not self.host_override:
+            return url
+        parsed = urlsplit(url)
+        query = '?' + parsed.query if parsed.query else ''
+        return f'{self.host_override}/{parsed.netloc}{parsed.path}{query}'
+
+    def _unroute(self, url: str) -> str:
+        prefix = self.host_override + '/'
+        if not self.host_override or not url.startswith(prefix):
+            return url
+        return 'https://' + url[len(prefix):]
+
+    def _session(self, store: str) -> ClientSession | curl.AsyncSession:
+        session = self.sessions.get(store)
+        if session is None:
+            session = self._create_session(STORE_CLIENTS.get(store, {'backend': 'aiohttp'}))
+            self.sessions[store] = session
+        return session
+
+    @staticmethod
+    def _create_session(options: dict) -> ClientSession | curl.AsyncSession:
+        # No backend keeps a cookie jar: parsers send their own cookies and read them back from
+        # Response.cookies, so a shared jar would only leak session and challenge cookies between products
+        if options['backend'] == 'curl':
+            return curl.AsyncSession(
+                impersonate=options['impersonate'],
+                max_clients=CONNECTIONS_PER_HOST,
+                http_version=CurlHttpVersion.V2TLS,
+                curl_options={CurlOpt.DNS_CACHE_TIMEOUT: DNS_CACHE_TTL},
+                discard_cookies=True
+            )
+
+        connector = TCPConnector(
+            limit_per_host=CONNECTIONS_PER_HOST,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            keepalive_timeout=KEEPALIVE_TIMEOUT
+        )
+        return ClientSession(connector=connector, cookie_jar=DummyCookieJar())
+
+    @staticmethod
+    async def _aiohttp_request(session, method, url, timeout, headers, cookies, json) -> Response:
+        try:
+            async with session.request(
+                method,
+                url,
+                headers=headers,
+                cookies=cookies,
+                json=json,
+                timeout=ClientTimeout(total=timeout)
+            ) as response:
+                text = await response.text()
+                return Response(
+                    status=response.status,
+                    url=str(response.url),
+                    text=text,
+                    headers=response.headers,
+                    cookies={name: morsel.value for name, morsel in response.cookies.items()}
+                )
+        except asyncio.TimeoutError as e:
+            raise TimeoutError(str(e)) from e
+
+    @staticmethod
+    async def _curl_request(session, method, url, timeout, headers, cookies, json) -> Response:
+        try:
+            response = await session.request(
+                method,
+                url,
+                headers=headers,
+                cookies=cookies,
+                json=json,
+                timeout=timeout
+            )
+        except CurlTimeout as e:
+            raise TimeoutError(str(e)) from e
+
+        return Response(
+            status=response.status_code,
+            url=response.url,
+            text=response.text,
+            headers=response.headers,
+            cookies=dict(response.cookies)
+        )
+
+
+registry = ClientRegistry(STORE_HOST_OVERRIDE)
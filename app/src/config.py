@@ -1,4 +1,5 @@
 import os
+import socket
 
 DBNAME = os.getenv('DBNAME')
 CONNSTRING = os.getenv('CONNSTRING')
@@ -6,3 +7,11 @@ WEBAPP_PATH = os.getenv('WEBAPP_PATH', '')
 WEBAPP_HOST = os.getenv('WEBAPP_HOST', '')
 WEBAPP_URL = f'https://{WEBAPP_HOST}/{WEBAPP_PATH}'
 PORT = int(os.getenv('PORT', '8000'))
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', str(os.cpu_count() or 1)))
+STORE_HOST_OVERRIDE = os.getenv('STORE_HOST_OVERRIDE', '')
+WORKER_ID = os.getenv('WORKER_ID', f'{socket.gethostname()}-{os.getpid()}')
+EMBEDDED_CRAWLER = os.getenv('EMBEDDED_CRAWLER', '1') == '1'
+WEBHOOK_ENABLED = os.getenv('WEBHOOK_ENABLED', '0') == '1'
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', WEBAPP_URL.rstrip('/') + WEBHOOK_PATH)
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
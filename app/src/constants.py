@@ -1,3 +1,4 @@
 STATUS_OK = 0
 STATUS_TIMEOUTERROR = 1
 STATUS_PARSINGERROR = 2
+STATUS_UNCHANGED = 3
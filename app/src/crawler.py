@@ -0,0 +1,260 @@
+import asyncio
+import logging
+import math
+from time import monotonic
+from typing import Any, Awaitable, Callable, Iterable
+
+from constants import STATUS_OK
+from settings import StoreSettings
+
+
+class StoreController:
+    SMOOTHING = 0.1
+    MIN_SAMPLES = 10
+    FAILURE_RATE = 0.5
+    MAX_DELAY = 60.0
+    OPEN_SECONDS = 300
+    MAX_OPEN_SECONDS = 3600
+
+    def __init__(self, name: str, max_concurrency: int, delay: float, slow_latency: float):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.base_delay = delay
+        self.slow_latency = slow_latency
+        self.window = float(max_concurrency)
+        self.delay = delay
+        self.error_rate = 0.0
+        self.latency = 0.0
+        self.samples = 0
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.open_seconds = self.OPEN_SECONDS
+        self.probing = False
+        self.active = 0
+        self.next_start = 0.0
+        self._condition = asyncio.Condition()
+        self._pacing = asyncio.Condition()
+
+    def configure(self, max_concurrency: int, delay: float, slow_latency: float):
+        self.max_concurrency = max_concurrency
+        self.base_delay = delay
+        self.slow_latency = slow_latency
+        self.window = min(self.window, max_concurrency)
+        self.delay = max(self.delay, delay)
+
+    @property
+    def concurrency(self) -> int:
+        return max(int(self.window), 1)
+
+    @property
+    def health(self) -> float:
+        return 1 - self.error_rate
+
+    def ready(self) -> bool:
+        return self.state != 'open' or monotonic() - self.opened_at >= self.open_seconds
+
+    def allow(self) -> bool:
+        if self.state == 'open' and self.ready():
+            self.state = 'half_open'
+            self.probing = False
+        if self.state == 'half_open':
+            # Let a single probe through until it reports back
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+        return self.state == 'closed'
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.active < self.concurrency)
+            self.active += 1
+
+    async def release(self):
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    async def settled(self):
+        # Wait for the running probe to report back
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.state != 'half_open' or not self.probing)
+
+    async def pace(self) -> float:
+        # Requests to a store start at least delay seconds apart, whatever the concurrency
+        async with self._pacing:
+            while (wait := self.next_start - monotonic()) > 0:
+                try:
+                    await asyncio.wait_for(self._pacing.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+            started = monotonic()
+            self.next_start = started + self.delay
+            return started
+
+    async def refund(self, started: float):
+        # A job answered from cache gives its turn back unless a later request already started
+        async with self._pacing:
+            if self.next_start == started + self.delay:
+                self.next_start = started
+                self._pacing.notify_all()
+
+    def reopens_in(self) -> float:
+        if self.state != 'open':
+            return 0.0
+        return max(self.opened_at + self.open_seconds - monotonic(), 0.0)
+
+    def record(self, status: int, latency: float) -> bool:
+        failure = status != STATUS_OK
+        self.samples += 1
+        self.error_rate += self.SMOOTHING * (failure - self.error_rate)
+        self.latency += self.SMOOTHING * (latency - self.latency)
+
+        if self.state == 'half_open':
+            if failure:
+                self._open(min(self.open_seconds * 2, self.MAX_OPEN_SECONDS))
+                return True
+            self.state = 'closed'
+            self.open_seconds = self.OPEN_SECONDS
+            self.error_rate = 0.0
+            self.samples = 0
+            return False
+
+        if failure or latency > self.slow_latency:
+            # Multiplicative decrease on errors and slow responses, additive increase otherwise
+            self.window = max(self.window / 2, 1.0)
+            self.delay = min(max(self.delay * 2, 0.5), self.MAX_DELAY)
+        else:
+            self.window = min(self.window + 1 / self.window, self.max_concurrency)
+            self.delay = max(self.delay - 0.1, self.base_delay)
+
+        if self.state == 'closed' and self.samples >= self.MIN_SAMPLES and self.error_rate >= self.FAILURE_RATE:
+            self._open(self.OPEN_SECONDS)
+            return True
+        return False
+
+    def _open(self, seconds: float):
+        self.state = 'open'
+        self.opened_at = monotonic()
+        self.open_seconds = seconds
+        logging.warning(f'{self.name} circuit opened for {seconds}s, error rate {self.error_rate:.2f}')
+
+    def get_string(self) -> str:
+        return (
+            f'{self.state}, concurrency {self.concurrency}/{self.max_concurrency}, delay {self.delay:.1f}s, '
+            f'errors {self.error_rate:.0%}, latency {self.latency:.1f}s'
+        )
+
+
+class StorePool:
+    def __init__(self, controller: StoreController):
+        self.name = controller.name
+        self.controller = controller
+
+    async def run(self, jobs: Iterable[Any], handler: Callable[[Any], Awaitable[bool]]):
+        queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+
+        workers = min(self.controller.max_concurrency, queue.qsize())
+        await asyncio.gather(*(self._worker(queue, handler) for _ in range(workers)))
+
+    async def _worker(self, queue: asyncio.Queue, handler: Callable[[Any], Awaitable[bool]]):
+        while True:
+            await self.controller.acquire()
+            if queue.empty():
+                await self.controller.release()
+                return
+            if not self.controller.allow():
+                await self.controller.release()
+                if self.controller.state == 'half_open':
+                    # Another worker is probing, carry on once it closes or reopens the circuit
+                    await self.controller.settled()
+                    continue
+                return
+
+            job = queue.get_nowait()
+            probe = self.controller.state == 'half_open'
+            fetched = False
+            started = await self.controller.pace()
+            try:
+                fetched = await handler(job)
+            except Exception as e:
+                logging.exception(f'{self.name} crawl job failed: {e}')
+            finally:
+                if not fetched:
+                    await self.controller.refund(started)
+                if probe:
+                    # A probe answered from cache reports nothing, let the next job probe instead
+                    self.controller.probing = False
+                await self.controller.release()
+
+
+class CheckPolicy:
+    CHANGE_SMOOTHING = 0.3
+    MIN_HEALTH = 0.25
+
+    def __init__(self, min_interval: int = 0, max_interval: int = 0):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+
+    def change_rate(self, previous: float, changed: bool) -> float:
+        return previous + self.CHANGE_SMOOTHING * (changed - previous)
+
+    def interval(self, change_rate: float, subscribers: int, health: float) -> int:
+        # Products that change on most checks stay at the base interval, idle ones drift to the maximum
+        interval = self.max_interval - (self.max_interval - self.min_interval) * change_rate
+        interval /= 1 + math.log10(max(subscribers, 1))
+        interval /= max(health, self.MIN_HEALTH)
+        return int(min(max(interval, self.min_interval), self.max_interval))
+
+
+class Crawler:
+    def __init__(self):
+        self.controllers: dict[str, StoreController] = {}
+        self.policy = CheckPolicy()
+
+    def configure(
+        self,
+        stores: dict[str, StoreSettings],
+        request_delay: float,
+        http_timeout: int,
+        check_interval: int,
+        max_check_interval: int
+    ):
+        self.policy = CheckPolicy(check_interval * 60, max_check_interval * 60)
+        controllers = {}
+        for name, store in stores.items():
+            concurrency = max(store.concurrency, 1)
+            delay = request_delay if store.request_delay is None else store.request_delay
+            controller = self.controllers.get(name)
+            if controller is None:
+                controller = StoreController(name, concurrency, delay, http_timeout / 2)
+            else:
+                controller.configure(concurrency, delay, http_timeout / 2)
+            controllers[name] = controller
+        self.controllers = controllers
+
+    def available(self, store: str) -> bool:
+        controller = self.controllers.get(store)
+        return controller is not None and controller.ready()
+
+    def reopens_in(self) -> float | None:
+        # Seconds until the first open circuit lets a probe through, None when none is open
+        waits = [controller.reopens_in() for controller in self.controllers.values() if controller.state == 'open']
+        return min(waits) if waits else None
+
+    def record(self, store: str, status: int, latency: float) -> bool:
+        controller = self.controllers.get(store)
+        return controller.record(status, latency) if controller else False
+
+    def next_check_at(self, store: str, now: int, change_rate: float, subscribers: int) -> int:
+        health = self.controllers[store].health if store in self.controllers else 1.0
+        return now + self.policy.interval(change_rate, subscribers, health)
+
+    async def run(self, jobs: dict[str, list[Any]], handler: Callable[[Any], Awaitable[bool]]):
+        await asyncio.gather(*(
+            StorePool(self.controllers[store]).run(store_jobs, handler)
+            for store, store_jobs in jobs.items()
+            if store in self.controllers
+        ))
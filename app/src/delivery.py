@@ -0,0 +1,118 @@
+import asyncio
+import logging
+from collections import defaultdict
+from time import monotonic
+from typing import Any, Awaitable, Callable
+
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+Request = Callable[[], Awaitable[Any]]
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class DeliveryEngine:
+    def __init__(
+        self,
+        rate: float = 30,
+        chat_interval: float = 1.0,
+        senders: int = 16,
+        max_retries: int = 3,
+        queue_size: int = 1000
+    ):
+        self.bucket = TokenBucket(rate, rate)
+        self.chat_interval = chat_interval
+        self.senders = senders
+        self.max_retries = max_retries
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.stats = defaultdict(int)
+        self._chat_next: dict[str, float] = {}
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._sender()) for _ in range(self.senders)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, chat_id: str, *requests: Request) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((str(chat_id), requests, future))
+        return future
+
+    async def _sender(self):
+        while True:
+            chat_id, requests, future = await self.queue.get()
+            try:
+                result = await self._deliver(chat_id, requests)
+            except Exception as e:
+                self.stats['failed'] += 1
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                self.stats['delivered'] += 1
+                if not future.cancelled():
+                    future.set_result(result)
+            finally:
+                self.queue.task_done()
+
+    async def _deliver(self, chat_id: str, requests: tuple[Request, ...]) -> list:
+        results = []
+        for request in requests:
+            for attempt in range(self.max_retries + 1):
+                await self._pace(chat_id)
+                await self.bucket.acquire()
+                try:
+                    results.append(await request())
+                    break
+                except TelegramRetryAfter as e:
+                    if attempt == self.max_retries:
+                        raise
+                    self.stats['retry_after'] += 1
+                    logging.warning(f'Flood control for chat {chat_id}, retry in {e.retry_after}s')
+                    self.bucket.pause(e.retry_after)
+                    await asyncio.sleep(e.retry_after)
+                except (TelegramNetworkError, TelegramServerError) as e:
+                    if attempt == self.max_retries:
+                        raise
+                    self.stats['retries'] += 1
+                    logging.warning(f'Send to chat {chat_id} failed: {e}, retrying')
+                    await asyncio.sleep(2 ** attempt)
+        return results
+
+    async def _pace(self, chat_id: str):
+        now = monotonic()
+        if len(self._chat_next) > 10000:
+            self._chat_next = {chat: ts for chat, ts in self._chat_next.items() if ts > now}
+        next_at = self._chat_next.get(chat_id, 0.0)
+        self._chat_next[chat_id] = max(now, next_at) + self.chat_interval
+        if next_at > now:
+            await asyncio.sleep(next_at - now)
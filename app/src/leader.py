@@ -0,0 +1,118 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+
+class LeaderLock:
+    def __init__(self, collection, name: str, owner: str, ttl: float = 15.0):
+        self.collection = collection
+        self.name = name
+        self.owner = owner
+        self.ttl = ttl
+        # Lease generation, grows on every takeover so a replica cannot renew a lease it has lost.
+        # Leader-side writes stamp it on the documents they touch and skip the ones a newer leader has
+        # stamped, so a replica that stalls past the ttl cannot overwrite its successor's work.
+        self.token: int | None = None
+        self.elected = asyncio.Event()
+        self.lost = asyncio.Event()
+        self.lost.set()
+        self._task: asyncio.Task | None = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self.elected.is_set()
+
+    def start(self, delay: float = 0):
+        self._task = asyncio.create_task(self._heartbeat(delay))
+
+    async def stop(self):
+        token = self.token if self.is_leader else None
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._step_down()
+        if token is not None:
+            await self.collection.update_one(
+                {'_id': self.name, 'owner': self.owner, 'token': token},
+                {'$set': {'expires_at': datetime.now(timezone.utc)}}
+            )
+
+    async def resign(self):
+        # Sit out long enough for the other replicas, which retry every ttl/3, to take the expired lock
+        await self.stop()
+        self.start(delay=self.ttl * 2)
+
+    async def verify(self) -> bool:
+        if not self.is_leader:
+            return False
+        document = await self.collection.find_one({
+            '_id': self.name,
+            'owner': self.owner,
+            'token': self.token,
+            'expires_at': {'$gt': datetime.now(timezone.utc)}
+        })
+        if document is None:
+            self._step_down()
+        return document is not None
+
+    async def _heartbeat(self, delay: float):
+        try:
+            await asyncio.sleep(delay)
+            while True:
+                try:
+                    leader = await self._renew() or await self._take_over()
+                except PyMongoError as e:
+                    logging.warning(f'Leader heartbeat failed: {e}')
+                    leader = False
+                except Exception as e:
+                    logging.exception(f'Leader heartbeat failed: {e}')
+                    leader = False
+
+                if leader and not self.is_leader:
+                    logging.warning(f'{self.owner} became leader with token {self.token}')
+                    self.lost.clear()
+                    self.elected.set()
+                elif not leader and self.is_leader:
+                    self._step_down()
+                await asyncio.sleep(self.ttl / 3)
+        finally:
+            # Without a heartbeat the lease runs out, never keep acting as leader past it
+            self._step_down()
+
+    async def _renew(self) -> bool:
+        if self.token is None:
+            return False
+        result = await self.collection.update_one(
+            {'_id': self.name, 'owner': self.owner, 'token': self.token},
+            {'$set': {'expires_at': datetime.now(timezone.utc) + timedelta(seconds=self.ttl)}}
+        )
+        return result.matched_count == 1
+
+    async def _take_over(self) -> bool:
+        now = datetime.now(timezone.utc)
+        try:
+            document = await self.collection.find_one_and_update(
+                {'_id': self.name, 'expires_at': {'$lt': now}},
+                {
+                    '$set': {'owner': self.owner, 'expires_at': now + timedelta(seconds=self.ttl)},
+                    '$inc': {'token': 1}
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Someone else holds a lease that has not expired yet
+            return False
+        self.token = document['token']
+        return True
+
+    def _step_down(self):
+        if self.is_leader:
+            logging.warning(f'{self.owner} lost leadership')
+        self.token = None
+        self.elected.clear()
+        self.lost.set()
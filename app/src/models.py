@@ -1,10 +1,12 @@
 from datetime import datetime
+from hashlib import md5
 from time import time
 from typing import Dict
 
 from aiogram.types import User as TgUser
 from pytz import timezone
 
+from constants import STATUS_OK
 from settings import StoreSettings
 
 class User:
@@ -70,6 +72,9 @@ class User:
 
 
 class Variant:
+    __slots__ = ('store', 'prodid', 'id', 'url', 'name', 'variant', 'price', 'currency', 'instock', 'key')
+    FIELDS = ('store', 'prodid', 'skuid', 'url', 'name', 'variant', 'price', 'currency', 'instock')
+
     def __init__(self, data: dict):
         self.store: str = data['store']
         self.prodid: str = data['prodid']
@@ -100,6 +105,9 @@ class Variant:
     def _del_str(self):
         return f'\n<i>Удалить: /del_{self.key}</i>'
 
+    def _history_str(self):
+        return f'\n<i>История цены: /history_{self.key}</i>'
+
     def get_string(self, *options):
         string_parts = []
 
@@ -134,9 +142,7 @@ class Sku(Variant):
         enable: bool,
         lastcheck: str,
         lastcheckts: int,
-        lastgoodts: int,
-        instock_prev: bool | None,
-        price_prev: int | None
+        lastgoodts: int
     ):
         self.store = variant.store
         self.prodid = variant.prodid
@@ -156,8 +162,6 @@ class Sku(Variant):
         self.lastcheck = lastcheck
         self.lastcheckts = lastcheckts
         self.lastgoodts = lastgoodts
-        self.instock_prev = instock_prev
-        self.price_prev = price_prev
         self.store_prodid = self.store + '_' + self.prodid
 
     @classmethod
@@ -170,9 +174,7 @@ class Sku(Variant):
             enable=data['enable'],
             lastcheck=data['lastcheck'],
             lastcheckts=data['lastcheckts'],
-            lastgoodts=data['lastgoodts'],
-            instock_prev=data['instock_prev'],
-            price_prev=data['price_prev']
+            lastgoodts=data['lastgoodts']
         )
 
     @classmethod
@@ -186,9 +188,7 @@ class Sku(Variant):
             enable=True,
             lastcheck=datetime.now(timezone('Asia/Yekaterinburg')).strftime('%d.%m.%Y %H:%M'),
             lastcheckts=timestamp,
-            lastgoodts=timestamp,
-            instock_prev=None,
-            price_prev=None
+            lastgoodts=timestamp
         )
 
     @classmethod
@@ -204,6 +204,65 @@ class Sku(Variant):
             icon = '⏳ '
         return icon
 
+    def to_json(self):
+        return {
+            '_id': self.doc_id,
+            'store': self.store,
+            'prodid': self.prodid,
+            'skuid': self.id,
+            'url': self.url,
+            'name': self.name,
+            'variant': self.variant,
+            'price': self.price,
+            'currency': self.currency,
+            'instock': self.instock,
+            'store_prodid': self.store_prodid,
+            'chat_id': self.chat_id,
+            'errors': self.errors,
+            'enable': self.enable,
+            'lastcheck': self.lastcheck,
+            'lastcheckts': self.lastcheckts,
+            'lastgoodts': self.lastgoodts
+        }
+
+
+class ChangeEvent(Variant):
+    MESSAGES = {
+        'instock': '✅ Снова в наличии!\n',
+        'outofstock': '🚫 Не в наличии\n',
+        'price_down': '📉 Снижение цены!\n',
+        'price_up': '📈 Повышение цены\n',
+    }
+
+    def __init__(self, data: dict):
+        super().__init__(data)
+        self.doc_id = data.get('_id')
+        self.chat_id: str = data['chat_id']
+        self.kind: str = data['kind']
+        self.price_prev: int | None = data.get('price_prev')
+        self.percents: int | None = data.get('percents')
+        self.warn: bool = data.get('warn', False)
+        self.attempts: int = data.get('attempts', 0)
+
+    @classmethod
+    def from_sku(cls, sku: Sku, chat_id: str, kind: str, price_prev: int | None = None, **extra) -> 'ChangeEvent':
+        data = {
+            'store': sku.store,
+            'prodid': sku.prodid,
+            'skuid': sku.id,
+            'url': sku.url,
+            'name': sku.name,
+            'variant': sku.variant,
+            'price': sku.price,
+            'currency': sku.currency,
+            'instock': sku.instock,
+            'chat_id': chat_id,
+            'kind': kind,
+            'price_prev': price_prev,
+            **extra
+        }
+        return cls(data)
+
     def _price_prev_str(self):
         return f' (было: {self.price_prev} {self.currency})'
 
@@ -213,24 +272,27 @@ class Sku(Variant):
             string_parts.append(self._store_str())
         if 'url' in options:
             string_parts.append(self._url_str())
-        if 'icon' in options:
-            string_parts.append(self._icon_str())
         if self.variant:
             string_parts.append(self.variant)
         if 'price' in options:
             string_parts.append(self._price_str())
-        if 'price_prev' in options:
+        if 'price_prev' in options and self.price_prev is not None:
             string_parts.append(self._price_prev_str())
-        if 'add' in options:
-            string_parts.append(self._add_str())
-        if 'del' in options:
-            string_parts.append(self._del_str())
+        if 'history' in options:
+            string_parts.append(self._history_str())
 
         return ''.join(string_parts)
 
-    def to_json(self):
+    def get_message(self) -> str:
+        if self.kind == 'deal':
+            skustring = self.get_string('store', 'url', 'price', 'price_prev')
+            return skustring + f' {self.percents}%' + ('‼️' if self.warn else '')
+        if self.kind in ('price_down', 'price_up'):
+            return self.MESSAGES[self.kind] + self.get_string('store', 'url', 'price', 'price_prev', 'history')
+        return self.MESSAGES[self.kind] + self.get_string('store', 'url', 'price', 'price_prev')
+
+    def to_json(self) -> dict:
         return {
-            '_id': self.doc_id,
             'store': self.store,
             'prodid': self.prodid,
             'skuid': self.id,
@@ -240,22 +302,81 @@ class Sku(Variant):
             'price': self.price,
             'currency': self.currency,
             'instock': self.instock,
-            'store_prodid': self.store_prodid,
             'chat_id': self.chat_id,
-            'errors': self.errors,
-            'enable': self.enable,
-            'lastcheck': self.lastcheck,
-            'lastcheckts': self.lastcheckts,
-            'lastgoodts': self.lastgoodts,
-            'instock_prev': self.instock_prev,
-            'price_prev': self.price_prev
+            'kind': self.kind,
+            'price_prev': self.price_prev,
+            'percents': self.percents,
+            'warn': self.warn,
+            'attempts': self.attempts
         }
 
 
+class PriceHistory:
+    SPARK_CHARS = '▁▂▃▄▅▆▇█'
+
+    def __init__(self, documents: list[dict]):
+        self.name = ''
+        self.variant = ''
+        self.currency = ''
+        self.points: list[tuple[int, int, bool]] = []
+        for document in documents:
+            self.name = document.get('name', self.name)
+            self.variant = document.get('variant', self.variant)
+            self.currency = document.get('currency', self.currency)
+            self.points.extend((ts, price, instock) for ts, price, instock in document['points'])
+        self.points.sort()
+
+    def sparkline(self, start: int, end: int, width: int) -> str:
+        step = (end - start) / width
+        values = []
+        index = 0
+        price = None
+        for bucket in range(width):
+            bucket_end = start + (bucket + 1) * step
+            while index < len(self.points) and self.points[index][0] <= bucket_end:
+                price = self.points[index][1]
+                index += 1
+            values.append(price)
+
+        known = [value for value in values if value is not None]
+        if not known:
+            return ''
+        low, high = min(known), max(known)
+        chars = []
+        for value in values:
+            if value is None:
+                chars.append(' ')
+            elif high == low:
+                chars.append(self.SPARK_CHARS[len(self.SPARK_CHARS) // 2])
+            else:
+                chars.append(self.SPARK_CHARS[round((value - low) / (high - low) * (len(self.SPARK_CHARS) - 1))])
+        return ''.join(chars)
+
+    def get_string(self, start: int, end: int, width: int = 30, changes: int = 10) -> list[str]:
+        if not self.points:
+            return ['История цены пока пуста']
+
+        before = [price for ts, price, _ in self.points if ts < start]
+        prices = before[-1:] + [price for ts, price, _ in self.points if ts >= start]
+        title = self.name + (f' ({self.variant})' if self.variant else '')
+        lines = [
+            f'📊 {title}\n<code>{self.sparkline(start, end, width)}</code>',
+            f'Мин: <b>{min(prices)} {self.currency}</b>, макс: <b>{max(prices)} {self.currency}</b>, '
+            f'сейчас: <b>{self.points[-1][1]} {self.currency}</b>'
+        ]
+        recent = []
+        for ts, price, instock in reversed(self.points[-changes:]):
+            date = datetime.fromtimestamp(ts, timezone('Asia/Yekaterinburg')).strftime('%d.%m.%Y')
+            recent.append(f'{date} — {price} {self.currency} ' + ('✅' if instock else '🚫'))
+        lines.append('\n'.join(recent))
+        return lines
+
+
 class Product:
-    def __init__(self, data: dict | None, source: str):
+    def __init__(self, data: dict | None, source: str, status: int = STATUS_OK):
         self.variants: Dict[str, Variant] = {}
         self.source = source
+        self.status = status
         self.id = None
         self.first_skuid = None
         self.name = None
@@ -283,3 +404,75 @@ class Product:
 
     def has_sku(self, skuid: str):
         return skuid in self.variants
+
+
+class Broadcast:
+    def __init__(
+        self,
+        text: str,
+        pin: bool,
+        store: str | None,
+        chat_id: str,
+        doc_id=None,
+        status: str = 'running',
+        last_user_id: str | None = None,
+        sent: int = 0,
+        failed: int = 0,
+        progress_message_id: int | None = None,
+        created_at: datetime | None = None
+    ):
+        self.doc_id = doc_id
+        self.text = text
+        self.hash = md5(text.encode('utf-8')).hexdigest()
+        self.pin = pin
+        self.store = store
+        self.chat_id = chat_id
+        self.status = status
+        self.last_user_id = last_user_id
+        self.sent = sent
+        self.failed = failed
+        self.progress_message_id = progress_message_id
+        self.created_at = created_at or datetime.now()
+
+    @property
+    def audience(self) -> dict:
+        query = {'enable': True, 'broadcasts': {'$ne': self.hash}}
+        if self.store:
+            query[f'store_counts.{self.store}'] = {'$gt': 0}
+        return query
+
+    def get_progress_string(self) -> str:
+        title = {'running': '🟢 Рассылка', 'done': '🔴 Рассылка завершена'}[self.status]
+        audience = f' ({self.store})' if self.store else ''
+        return f'{title}{audience}\nОтправлено: {self.sent}\nОшибок: {self.failed}'
+
+    @classmethod
+    def from_document(cls, data: dict) -> 'Broadcast':
+        return cls(
+            doc_id=data['_id'],
+            text=data['text'],
+            pin=data['pin'],
+            store=data.get('store'),
+            chat_id=data['chat_id'],
+            status=data['status'],
+            last_user_id=data.get('last_user_id'),
+            sent=data.get('sent', 0),
+            failed=data.get('failed', 0),
+            progress_message_id=data.get('progress_message_id'),
+            created_at=data.get('created_at')
+        )
+
+    def to_json(self) -> dict:
+        return {
+            'text': self.text,
+            'hash': self.hash,
+            'pin': self.pin,
+            'store': self.store,
+            'chat_id': self.chat_id,
+            'status': self.status,
+            'last_user_id': self.last_user_id,
+            'sent': self.sent,
+            'failed': self.failed,
+            'progress_message_id': self.progress_message_id,
+            'created_at': self.created_at
+        }
@@ -1,19 +1,167 @@
+import asyncio
+import html
+import hashlib
 import json
+import logging
 import re
 import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from itertools import product
+from multiprocessing import get_context
+from time import time
 
 import crcmod.predefined
-from aiohttp import ClientSession, ClientTimeout
-from bs4 import BeautifulSoup
-from curl_cffi import requests as curl
+from bs4 import BeautifulSoup, SoupStrainer
 from urllib.parse import urljoin, urlparse, urlunparse
 
-from constants import STATUS_OK, STATUS_TIMEOUTERROR, STATUS_PARSINGERROR
+import clients
+from constants import STATUS_OK, STATUS_TIMEOUTERROR, STATUS_PARSINGERROR, STATUS_UNCHANGED
 
 crc16 = crcmod.predefined.Crc('crc-16')
 crc32 = crcmod.predefined.Crc('crc-32')
 
+B24_CLEARANCE_LIFETIME = 3600
+
+# Fast-path scanners: pull single nodes out of the raw page without building a DOM.
+# Attribute values may contain '>' inside quotes, hence the quoted-string alternatives.
+TAG_ATTRS = r"""((?:[^>"']|"[^"]*"|'[^']*')*)"""
+ATTR_RE = re.compile(r"""([^\s=/>]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))""")
+ARTICLE_TAG_RE = re.compile(r'<article\b' + TAG_ATTRS + '>', re.I)
+DIV_TAG_RE = re.compile(r'<div\b' + TAG_ATTRS + '>', re.I)
+FORM_TAG_RE = re.compile(r'<form\b' + TAG_ATTRS + '>', re.I)
+SCRIPT_RE = re.compile(r'<script\b' + TAG_ATTRS + r'>(.*?)</script>', re.I | re.S)
+DATALAYER_RE = re.compile(r'dataLayer.push\((\{"event":.+?)\);', re.S)
+CRC_JSON_RE = re.compile(r'type="application/json">(.+)</script>', re.S)
+A4C_PRODUCT_RE = re.compile(r'_ReStockConfig.product = {(.+?)};', re.S)
+A4C_TRAILING_COMMA_RE = re.compile(r',(\s*[}\]])')
+A4C_KEY_RE = re.compile(r'(\w+)\s*:')
+SB_STRAINER = SoupStrainer(lambda name, attrs: name == 'title' or 'meta-id' in attrs)
+SB_PAYLOAD_RE = re.compile(r'<title>[^<]*|<(\w+)\b[^>]*\bmeta-id="[^"]*"[^>]*>', re.I)
+
+
+def tag_attrs(raw_attrs: str) -> dict[str, str]:
+    attrs = {}
+    for match in ATTR_RE.finditer(raw_attrs):
+        value = next(group for group in match.groups()[1:] if group is not None)
+        attrs.setdefault(match.group(1).lower(), html.unescape(value))
+    return attrs
+
+
+def find_tag_attr(tag_re: re.Pattern, content: str, attr: str, **conditions) -> str | None:
+    for match in tag_re.finditer(content):
+        attrs = tag_attrs(match.group(1))
+        if attr in attrs and all(attrs.get(key) == value for key, value in conditions.items()):
+            return attrs[attr]
+    return None
+
+
+def element_html(content: str, start: int, name: str) -> str | None:
+    # Outer HTML of the element opened at start, following nested tags of the same name
+    depth = 0
+    for tag in re.finditer(rf'<(/?){name}\b[^>]*>', content[start:], re.I):
+        depth += -1 if tag.group(1) else 1
+        if depth == 0:
+            return content[start:start + tag.end()]
+    return None
+
+
+def find_scripts(content: str, script_type: str) -> list[str]:
+    return [
+        match.group(2)
+        for match in SCRIPT_RE.finditer(content)
+        if tag_attrs(match.group(1)).get('type') == script_type
+    ]
+
+
+def conditional_headers(validators: dict | None, headers: dict | None = None) -> dict:
+    headers = dict(headers or {})
+    if validators and validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators and validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def payload_hash(payload: str) -> str:
+    return hashlib.md5(payload.encode('utf-8')).hexdigest()
+
+
+async def fetch_with_validators(store: str, url: str, httptimeout: int, validators: dict | None, fingerprint, headers: dict | None = None):
+    # Returns the response, its validators and whether the relevant payload is unchanged
+    response = await clients.registry.get(store, url, httptimeout, headers=conditional_headers(validators, headers))
+    if response.status == 304 and validators:
+        return response, validators, True
+
+    current = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'hash': payload_hash(fingerprint(response.text) or response.text)
+    }
+    return response, current, bool(validators) and validators.get('hash') == current['hash']
+
+
+def unchanged_result(validators: dict) -> dict:
+    return {'status': STATUS_UNCHANGED, 'variants': None, 'validators': validators}
+
+
+class ChallengeClearance:
+    def __init__(self, lifetime: int):
+        self.lifetime = lifetime
+        self.cookies: dict | None = None
+        self.expires = 0
+        self.lock = asyncio.Lock()
+
+    def get(self) -> dict | None:
+        if self.cookies is not None and time() < self.expires:
+            return self.cookies
+        return None
+
+    def store(self, cookies: dict):
+        self.cookies = cookies
+        self.expires = time() + self.lifetime
+
+    def reject(self, cookies: dict | None):
+        if cookies is not None and cookies is self.cookies:
+            self.cookies = None
+
+
+b24_clearance = ChallengeClearance(B24_CLEARANCE_LIFETIME)
+
+parse_pool: ProcessPoolExecutor | None = None
+parse_pool_workers: int | None = None
+
+
+def start_parse_pool(max_workers: int | None = None):
+    global parse_pool, parse_pool_workers
+    parse_pool_workers = max_workers
+    # Spawned, not forked: the parent already runs an event loop and client threads
+    parse_pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=get_context('spawn'))
+
+
+def stop_parse_pool():
+    global parse_pool
+    if parse_pool is not None:
+        parse_pool.shutdown(wait=False, cancel_futures=True)
+        parse_pool = None
+
+
+async def run_extractor(extractor, *args):
+    pool = parse_pool
+    if pool is None:
+        return extractor(*args)
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(pool, extractor, *args)
+    except BrokenProcessPool:
+        # A worker died, replace the pool once and parse this page in-process
+        if pool is parse_pool:
+            logging.error('Parse pool is broken, restarting it')
+            pool.shutdown(wait=False, cancel_futures=True)
+            start_parse_pool(parse_pool_workers)
+        return extractor(*args)
+
+
 def build_headers(url: str) -> dict[str, str]:
         parsed = urlparse(url)
         origin = f"{parsed.scheme}://{parsed.netloc}"
@@ -29,58 +177,82 @@ def build_headers(url: str) -> dict[str, str]:
         }
 
 
-async def parseSB(url, httptimeout):
-    headers = {
-        'Cookie': 'country=RU; currency_relaunch=EUR; vat=hide'
-    }
-    try:
-        async with curl.AsyncSession() as session:
-            response = await session.get(url, impersonate='safari15_5', timeout=httptimeout, headers=headers)
-            content = response.text
-            url = response.url
-
+def extractSB(content, url):
+    soup = BeautifulSoup(content, 'lxml', parse_only=SB_STRAINER)
+    if soup.find('title') is None or soup.find('span', {'class': 'dropdownbox-price'}) is None:
         soup = BeautifulSoup(content, 'lxml')
-        prodid = str(crc32.new(url.encode('utf-8')).crcValue)
-        name = soup.find('title').text
+    prodid = str(crc32.new(url.encode('utf-8')).crcValue)
+    name = soup.find('title').text
 
-        def findVarnames(tag):
-            return tag.name == 'a' and 'meta-id' in tag.attrs
+    def findVarnames(tag):
+        return tag.name == 'a' and 'meta-id' in tag.attrs
 
-        varnames = {}
-        for x in soup.find_all(findVarnames):
-            varnames[x['meta-id']] = x.text.strip()
+    varnames = {}
+    for x in soup.find_all(findVarnames):
+        varnames[x['meta-id']] = x.text.strip()
 
-        instock = {}
-        for x in soup.find_all('span', {'class': 'dropdownbox-eta'}):
-            instock[x['meta-id']] = False if 'uk-text-danger' in x['class'] else True
+    instock = {}
+    for x in soup.find_all('span', {'class': 'dropdownbox-eta'}):
+        instock[x['meta-id']] = False if 'uk-text-danger' in x['class'] else True
 
-        variants = {}
-        for x in soup.find_all('span', {'class': 'dropdownbox-price'}):
-            if len(varnames) == 1:
-                skuid = '0'
-                variant = ''
-            else:
-                skuid = x['meta-id']
-                variant = varnames[x['meta-id']]
-            variants[skuid] = {}
-            variants[skuid]['variant'] = variant
-            variants[skuid]['prodid'] = prodid
-            pricetxt = re.sub(r'[^0-9.]', '', x.text)
-            variants[skuid]['price'] = int(float(pricetxt))
-            variants[skuid]['currency'] = 'EUR'
-            variants[skuid]['store'] = 'SB'
-            variants[skuid]['url'] = url
-            variants[skuid]['name'] = name
-            variants[skuid]['instock'] = instock[x['meta-id']]
+    variants = {}
+    for x in soup.find_all('span', {'class': 'dropdownbox-price'}):
+        if len(varnames) == 1:
+            skuid = '0'
+            variant = ''
+        else:
+            skuid = x['meta-id']
+            variant = varnames[x['meta-id']]
+        variants[skuid] = {}
+        variants[skuid]['variant'] = variant
+        variants[skuid]['prodid'] = prodid
+        pricetxt = re.sub(r'[^0-9.]', '', x.text)
+        variants[skuid]['price'] = int(float(pricetxt))
+        variants[skuid]['currency'] = 'EUR'
+        variants[skuid]['store'] = 'SB'
+        variants[skuid]['url'] = url
+        variants[skuid]['name'] = name
+        variants[skuid]['instock'] = instock[x['meta-id']]
+
+    return variants
+
+
+def fingerprintSB(content):
+    # Title plus every meta-id element with its nested markup, where the names, prices and stock live
+    parts = []
+    for match in SB_PAYLOAD_RE.finditer(content):
+        if match.group(1) is None:
+            parts.append(match.group(0))
+            continue
+        element = element_html(content, match.start(), match.group(1))
+        if element is None:
+            # Unbalanced markup, hash the whole page instead
+            return None
+        parts.append(element)
+    return ''.join(parts)
 
-        return {'status': STATUS_OK, 'variants': variants}
+
+async def parseSB(url, httptimeout, validators=None):
+    headers = {
+        'Cookie': 'country=RU; currency_relaunch=EUR; vat=hide'
+    }
+    try:
+        response, validators, unchanged = await fetch_with_validators('SB', url, httptimeout, validators, fingerprintSB, headers)
+        if unchanged:
+            return unchanged_result(validators)
+        variants = await run_extractor(extractSB, response.text, response.url)
+        return {'status': STATUS_OK, 'variants': variants, 'validators': validators}
     except TimeoutError:
         return {'status': STATUS_TIMEOUTERROR, 'variants': None}
     except Exception:
         return {'status': STATUS_PARSINGERROR, 'variants': None}
     
 
-async def fetch_B24(url: str, httptimeout: int, impersonate: str):
+def is_interstitial_challenge(html: str) -> bool:
+    return "/_sec/verify?provider=interstitial" in html and '"bm-verify"' in html
+
+
+async def fetch_B24(url: str, httptimeout: int):
 
     POW_RE = re.compile(
         r"var\s+i\s*=\s*(\d+)\s*;"
@@ -141,11 +313,7 @@ async def fetch_B24(url: str, httptimeout: int, impersonate: str):
         raise ValueError("Не найден bm-verify token в challenge-скрипте")
 
 
-    def is_interstitial_challenge(html: str) -> bool:
-        return "/_sec/verify?provider=interstitial" in html and '"bm-verify"' in html
-
-
-    def solve_interstitial_challenge(session: curl.Session, response: curl.Response) -> curl.Response:
+    async def solve_interstitial_challenge(response: clients.Response, cookies: dict) -> clients.Response:
         html = response.text
         soup = BeautifulSoup(html, "lxml")
         page_url = response.url
@@ -158,14 +326,16 @@ async def fetch_B24(url: str, httptimeout: int, impersonate: str):
         verify_url = f"{parsed.scheme}://{parsed.netloc}/_sec/verify?provider=interstitial"
         headers = build_headers(page_url)
 
-        verify_response = session.post(
+        verify_response = await clients.registry.post(
+            "B24",
             verify_url,
+            httptimeout,
             json={"bm-verify": bm_verify, "pow": pow_value},
             headers=headers,
-            impersonate=impersonate,
-            timeout=httptimeout,
+            cookies=cookies,
         )
         verify_response.raise_for_status()
+        cookies.update(verify_response.cookies)
 
         try:
             data = verify_response.json()
@@ -181,149 +351,219 @@ async def fetch_B24(url: str, httptimeout: int, impersonate: str):
         else:
             next_url = page_url
 
-        return session.get(
+        return await clients.registry.get(
+            "B24",
             next_url,
+            httptimeout,
             headers=build_headers(next_url),
-            impersonate=impersonate,
-            timeout=httptimeout,
+            cookies=cookies,
         )
 
 
-    def fetch_original_page(url: str):
-        session = curl.Session()
-        response = session.get(
+    async def get_page(url: str, cookies: dict | None) -> clients.Response:
+        return await clients.registry.get(
+            "B24",
             url,
+            httptimeout,
             headers=build_headers(url),
-            impersonate=impersonate,
-            timeout=httptimeout,
+            cookies=cookies,
         )
-        response.raise_for_status()
 
-        if not is_interstitial_challenge(response.text):
-            return response
 
-        final_response = solve_interstitial_challenge(session, response)
-        final_response.raise_for_status()
-        return final_response.text, session.cookies
+    async def fetch_original_page(url: str):
+        clearance = b24_clearance.get()
+        response = await get_page(url, clearance)
+
+        if not is_interstitial_challenge(response.text):
+            response.raise_for_status()
+            if clearance is None:
+                return response.text, dict(response.cookies)
+            clearance.update(response.cookies)
+            return response.text, clearance
+
+        b24_clearance.reject(clearance)
+        async with b24_clearance.lock:
+            renewed = b24_clearance.get()
+            if renewed is not None:
+                response = await get_page(url, renewed)
+                if not is_interstitial_challenge(response.text):
+                    response.raise_for_status()
+                    renewed.update(response.cookies)
+                    return response.text, renewed
+                b24_clearance.reject(renewed)
+
+            cookies = dict(response.cookies)
+            final_response = await solve_interstitial_challenge(response, cookies)
+            final_response.raise_for_status()
+            cookies.update(final_response.cookies)
+            b24_clearance.store(cookies)
+            return final_response.text, cookies
+
+    return await fetch_original_page(url)
+
+
+def extractB24Props(content):
+    props = find_tag_attr(DIV_TAG_RE, content, 'data-props', id='add-to-cart')
+    if props is None:
+        soup = BeautifulSoup(content, 'lxml')
+        res = soup.find('div', {'id': 'add-to-cart'})
+        props = res['data-props']
+    return json.loads(props)
+
+
+def extractB24(jsdata, availdata, url):
+    price = int(float(jsdata['ga4GtmData']['price']))
+    prodid = str(jsdata['ga4GtmData']['item_id'])
+    name = jsdata['ga4GtmData']['item_name']
+    currency = jsdata['productDetailPrice']['currencyCode']
+    coeff = 1.191
+
+    availdict = {}
+    availjson = json.loads(availdata)
+    for key, value in availjson['availabilityVariantsList'].items():
+        if ',' in key:
+            skuid_parts = key.split(',')
+            tmp = []
+            for part in skuid_parts:                    
+                tmp.append(part.split('=')[-1])
+            s = '_'.join(sorted(tmp)).encode('utf-8')
+            skuid = str(crc16.new(s).crcValue)
+        elif '=' in key:
+            skuid = key.split('=')[-1]
+        else:
+            skuid = key
+        availdict[skuid] = value['availability']['currentStock'] > 0
+
+    variants = {}
+
+    if jsdata['productOptionList']:            
+        options = jsdata['productOptionList']
+        lists = [opt['optionValueList'] for opt in options]
+        combos = {}
+        for combo in product(*lists):
+            ids = []
+            optnames = []
+            surcharge = 0
+            for x in combo:
+                optname = x['name'].replace('not deliverable: ', '')
+                optname = re.sub(r' - add \d+.+$', '', optname)
+                optnames.append(optname)
+                ids.append(str(x['id']))                    
+                surcharge += x['surcharge']
+
+            if len(ids) > 1:                      
+                s = "_".join(sorted(ids)).encode('utf-8')
+                key = str(crc16.new(s).crcValue)
+            else:
+                key = ids[0]                    
 
-    return fetch_original_page(url)
+            combos[key] = {
+                "variant": ', '.join(optnames),
+                "surcharge": surcharge
+            }
 
+        for skuid, sku in combos.items():
+            variants[skuid] = {}
+            variants[skuid]['instock'] = availdict[skuid]
+            variants[skuid]['variant'] = sku['variant']
+            variants[skuid]['prodid'] = prodid
+            variants[skuid]['price'] = price + int(sku['surcharge']*coeff)
+            variants[skuid]['currency'] = currency
+            variants[skuid]['store'] = 'B24'
+            variants[skuid]['url'] = url
+            variants[skuid]['name'] = name
+    else:
+        variants['0'] = {}
+        variants['0']['variant'] = ""
+        variants['0']['prodid'] = prodid
+        variants['0']['price'] = price
+        variants['0']['currency'] = currency
+        variants['0']['store'] = 'B24'
+        variants['0']['url'] = url
+        variants['0']['name'] = name
+        variants['0']['instock'] = availdict[prodid]
 
-async def parseB24(url, httptimeout):
-    try:
-        IMPERSONATE = "firefox"
-        content, cookies = await fetch_B24(url, httptimeout, IMPERSONATE)
+    return variants
 
-        soup = BeautifulSoup(content, 'lxml')
-        res = soup.find('div', {'id': 'add-to-cart'})
-        jsdata = json.loads(res['data-props'])
 
-        price = int(float(jsdata['ga4GtmData']['price']))
+async def parseB24(url, httptimeout, validators=None):
+    try:
+        content, cookies = await fetch_B24(url, httptimeout)
+        jsdata = await run_extractor(extractB24Props, content)
         prodid = str(jsdata['ga4GtmData']['item_id'])
-        name = jsdata['ga4GtmData']['item_name']
-        currency = jsdata['productDetailPrice']['currencyCode']
-        coeff = 1.191
 
         jsurl = f'https://www.bike24.com/api/product/{prodid}/availability?deliveryCountryId=4&zipCode='
-        async with curl.AsyncSession() as s:            
-            response = await s.get(
+        response = await clients.registry.get(
+            'B24',
+            jsurl,
+            httptimeout,
+            cookies=cookies,
+            headers=build_headers(url))
+        if response.status == 403 or is_interstitial_challenge(response.text):
+            b24_clearance.reject(cookies)
+            _, cookies = await fetch_B24(url, httptimeout)
+            response = await clients.registry.get(
+                'B24',
                 jsurl,
-                impersonate='firefox',
-                timeout=httptimeout,
+                httptimeout,
                 cookies=cookies,
-                headers=build_headers(url))        
-            availdata = response.text
-
-        availdict = {}
-        availjson = json.loads(availdata)
-        for key, value in availjson['availabilityVariantsList'].items():
-            if ',' in key:
-                skuid_parts = key.split(',')
-                tmp = []
-                for part in skuid_parts:                    
-                    tmp.append(part.split('=')[-1])
-                s = '_'.join(sorted(tmp)).encode('utf-8')
-                skuid = str(crc16.new(s).crcValue)
-            elif '=' in key:
-                skuid = key.split('=')[-1]
-            else:
-                skuid = key
-            availdict[skuid] = value['availability']['currentStock'] > 0
-
-        variants = {}
-
-        if jsdata['productOptionList']:            
-            options = jsdata['productOptionList']
-            lists = [opt['optionValueList'] for opt in options]
-            combos = {}
-            for combo in product(*lists):
-                ids = []
-                optnames = []
-                surcharge = 0
-                for x in combo:
-                    optname = x['name'].replace('not deliverable: ', '')
-                    optname = re.sub(r' - add \d+.+$', '', optname)
-                    optnames.append(optname)
-                    ids.append(str(x['id']))                    
-                    surcharge += x['surcharge']
-
-                if len(ids) > 1:                      
-                    s = "_".join(sorted(ids)).encode('utf-8')
-                    key = str(crc16.new(s).crcValue)
-                else:
-                    key = ids[0]                    
-
-                combos[key] = {
-                    "variant": ', '.join(optnames),
-                    "surcharge": surcharge
-                }
-
-            for skuid, sku in combos.items():
-                variants[skuid] = {}
-                variants[skuid]['instock'] = availdict[skuid]
-                variants[skuid]['variant'] = sku['variant']
-                variants[skuid]['prodid'] = prodid
-                variants[skuid]['price'] = price + int(sku['surcharge']*coeff)
-                variants[skuid]['currency'] = currency
-                variants[skuid]['store'] = 'B24'
-                variants[skuid]['url'] = url
-                variants[skuid]['name'] = name
-        else:
-            variants['0'] = {}
-            variants['0']['variant'] = ""
-            variants['0']['prodid'] = prodid
-            variants['0']['price'] = price
-            variants['0']['currency'] = currency
-            variants['0']['store'] = 'B24'
-            variants['0']['url'] = url
-            variants['0']['name'] = name
-            variants['0']['instock'] = availdict[prodid]
-
-        return {'status': STATUS_OK, 'variants': variants}
+                headers=build_headers(url))
+
+        # The page itself is behind a challenge, so only the extracted props and availability are compared
+        current = {'hash': payload_hash(json.dumps(jsdata, sort_keys=True) + response.text)}
+        if validators and validators.get('hash') == current['hash']:
+            return unchanged_result(current)
+        variants = await run_extractor(extractB24, jsdata, response.text, url)
+        return {'status': STATUS_OK, 'variants': variants, 'validators': current}
     except TimeoutError:
         return {'status': STATUS_TIMEOUTERROR, 'variants': None}
     except Exception:
         return {'status': STATUS_PARSINGERROR, 'variants': None}
 
 
-async def parseTI(url, httptimeout):
-    id_pais = 164
+TI_ID_PAIS = 164
+
+
+def extractTI(jscontent, url, prodid):
+    id_pais = TI_ID_PAIS
+    jsdata = json.loads(jscontent)['_source']
+    name = jsdata['marca'] + ' ' + jsdata['model']['eng']
+    variants = {}
+    for var in jsdata['productes']:
+        if not var['sellers']: continue
+        prices = {x['id_pais']: x['precio'] for s in var['sellers'] for x in s['precios_paises']}
+        if id_pais not in prices: continue
+
+        skuid = var['id_producte']
+        variants[skuid] = {}
+        varname = filter(None, [var['talla'], var['talla2'], var['color']])
+        variants[skuid]['variant'] = ' '.join(varname)
+        variants[skuid]['prodid'] = prodid
+        variants[skuid]['price'] = int(prices[id_pais])
+        variants[skuid]['currency'] = 'RUB'
+        variants[skuid]['store'] = 'TI'
+        variants[skuid]['url'] = url
+        variants[skuid]['name'] = name
+        variants[skuid]['instock'] = True
+
+    return variants
+
+
+async def parseTI(url, httptimeout, validators=None):
     headers = {
-        'Cookie': f'id_pais={id_pais}',
+        'Cookie': f'id_pais={TI_ID_PAIS}',
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:123.0) Gecko/20100101 Firefox/123.0',
         'Host': 'www.tradeinn.com',
         'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
         'Accept-Language': 'en-US,en;q=0.8,ru;q=0.5,ru-RU;q=0.3',
         'Accept-Encoding': 'gzip, deflate, br'
     }
-    timeout = ClientTimeout(total=httptimeout)
     url = url.replace(chr(160), '')
     url = urllib.parse.quote(url, safe=':/')
 
     try:
-        async with ClientSession(headers=headers, timeout=timeout) as session:
-            async with session.get(url) as response:
-                url = str(response.url)
+        response = await clients.registry.get('TI', url, httptimeout, headers=headers)
+        url = response.url
 
         rg = re.search(r'(https://www\.tradeinn\.com/)(.+?)/(.+?)(/\S+/)(\d+)/p', url)
         url = rg.group(1) + 'bikeinn/en' + rg.group(4) + rg.group(5) + '/p'
@@ -339,153 +579,164 @@ async def parseTI(url, httptimeout):
             'Origin': 'https://www.tradeinn.com'
         }
 
-        async with ClientSession(headers=headers, timeout=timeout) as session:
-            async with session.get(jsurl) as response:
-                jscontent = await response.text()
+        response, validators, unchanged = await fetch_with_validators('TI', jsurl, httptimeout, validators, str, headers)
+        if unchanged:
+            return unchanged_result(validators)
+        variants = await run_extractor(extractTI, response.text, url, prodid)
+        return {'status': STATUS_OK, 'variants': variants, 'validators': validators}
+    except TimeoutError:
+        return {'status': STATUS_TIMEOUTERROR, 'variants': None}
+    except Exception:
+        return {'status': STATUS_PARSINGERROR, 'variants': None}
+
 
-        jsdata = json.loads(jscontent)['_source']
-        name = jsdata['marca'] + ' ' + jsdata['model']['eng']
-        variants = {}
-        for var in jsdata['productes']:
-            if not var['sellers']: continue
-            prices = {x['id_pais']: x['precio'] for s in var['sellers'] for x in s['precios_paises']}
-            if id_pais not in prices: continue
+def extractBC(content, url):
+    def findVariants(tag):
+        return tag.name == 'script' and tag.get('type') == 'application/ld+json'
 
-            skuid = var['id_producte']
+    scripts = find_scripts(content, 'application/ld+json')
+    if not scripts:
+        soup = BeautifulSoup(content, 'lxml')
+        scripts = [x.text for x in soup.find_all(findVariants)]
+
+    jsdata = {}
+    variants = {}
+    for x in scripts:
+        jsdata = json.loads(x)
+        if jsdata.get('@type') in ['Product', 'ProductGroup']:
+            break
+
+    if jsdata['@type'] == 'Product':
+        skus = jsdata['offers']
+        for sku in skus:
+            skuid = sku['sku'].replace(str(jsdata['sku']), '').replace('-', '')
             variants[skuid] = {}
-            varname = filter(None, [var['talla'], var['talla2'], var['color']])
-            variants[skuid]['variant'] = ' '.join(varname)
-            variants[skuid]['prodid'] = prodid
-            variants[skuid]['price'] = int(prices[id_pais])
-            variants[skuid]['currency'] = 'RUB'
-            variants[skuid]['store'] = 'TI'
+            variants[skuid]['variant'] = sku['name'].replace('\/', '/')
+            variants[skuid]['prodid'] = str(jsdata['sku'])
+            psdict = {p['priceType']: p for p in sku['priceSpecification']}
+            ps = psdict.get('https://schema.org/SalePrice') or psdict.get('https://schema.org/ListPrice')
+            variants[skuid]['price'] = int(ps['price'])
+            if 'True' in ps['valueAddedTaxIncluded']:
+                variants[skuid]['price'] = int(ps['price']*0.84)
+            variants[skuid]['currency'] = ps['priceCurrency']
+            variants[skuid]['store'] = 'BC'
             variants[skuid]['url'] = url
-            variants[skuid]['name'] = name
-            variants[skuid]['instock'] = True
+            variants[skuid]['name'] = (jsdata['brand']['name'] + ' ' + jsdata['name'].replace('\/', '/'))
+            variants[skuid]['instock'] = 'InStock' in sku['availability']
 
-        return {'status': STATUS_OK, 'variants': variants}
-    except TimeoutError:
-        return {'status': STATUS_TIMEOUTERROR, 'variants': None}
-    except Exception:
-        return {'status': STATUS_PARSINGERROR, 'variants': None}
+    if jsdata['@type'] == 'ProductGroup':
+        skus = jsdata['hasVariant']
+        for sku in skus:
+            skuid = sku['sku'].replace(str(jsdata['productGroupID']), '').replace('-', '')
+            variants[skuid] = {}
+            variants[skuid]['variant'] = sku['name'].replace('\/', '/')
+            variants[skuid]['prodid'] = str(jsdata['productGroupID'])
+            psdict = {p['priceType']: p for p in sku['offers']['priceSpecification']}
+            ps = psdict.get('https://schema.org/SalePrice') or psdict.get('https://schema.org/ListPrice')
+            variants[skuid]['price'] = int(ps['price'])
+            if 'True' in ps['valueAddedTaxIncluded']:
+                variants[skuid]['price'] = int(ps['price']*0.84)
+            variants[skuid]['currency'] = ps['priceCurrency']
+            variants[skuid]['store'] = 'BC'
+            variants[skuid]['url'] = url
+            variants[skuid]['name'] = (jsdata['brand']['name'] + ' ' + jsdata['name'].replace('\/', '/'))
+            variants[skuid]['instock'] = 'InStock' in sku['offers']['availability']
 
+    return variants
 
-async def parseBC(url, httptimeout):
-    headers = {}
-    timeout = ClientTimeout(total=httptimeout)
-    try:
-        async with ClientSession(headers=headers, timeout=timeout) as session:
-            async with session.get(url) as response:
-                content = await response.text()
-                url = str(response.url)
 
-        def findVariants(tag):
-            return tag.name == 'script' and tag.get('type') == 'application/ld+json'
+def fingerprintBC(content):
+    return ''.join(find_scripts(content, 'application/ld+json'))
 
-        soup = BeautifulSoup(content, 'lxml')
-        res = soup.find_all(findVariants)
-        jsdata = {}
-        variants = {}
-        for x in res:
-            jsdata = json.loads(x.text)
-            if jsdata.get('@type') in ['Product', 'ProductGroup']:
-                break
-
-        if jsdata['@type'] == 'Product':
-            skus = jsdata['offers']
-            for sku in skus:
-                skuid = sku['sku'].replace(str(jsdata['sku']), '').replace('-', '')
-                variants[skuid] = {}
-                variants[skuid]['variant'] = sku['name'].replace('\/', '/')
-                variants[skuid]['prodid'] = str(jsdata['sku'])
-                psdict = {p['priceType']: p for p in sku['priceSpecification']}
-                ps = psdict.get('https://schema.org/SalePrice') or psdict.get('https://schema.org/ListPrice')
-                variants[skuid]['price'] = int(ps['price'])
-                if 'True' in ps['valueAddedTaxIncluded']:
-                    variants[skuid]['price'] = int(ps['price']*0.84)
-                variants[skuid]['currency'] = ps['priceCurrency']
-                variants[skuid]['store'] = 'BC'
-                variants[skuid]['url'] = url
-                variants[skuid]['name'] = (jsdata['brand']['name'] + ' ' + jsdata['name'].replace('\/', '/'))
-                variants[skuid]['instock'] = 'InStock' in sku['availability']
-
-        if jsdata['@type'] == 'ProductGroup':
-            skus = jsdata['hasVariant']
-            for sku in skus:
-                skuid = sku['sku'].replace(str(jsdata['productGroupID']), '').replace('-', '')
-                variants[skuid] = {}
-                variants[skuid]['variant'] = sku['name'].replace('\/', '/')
-                variants[skuid]['prodid'] = str(jsdata['productGroupID'])
-                psdict = {p['priceType']: p for p in sku['offers']['priceSpecification']}
-                ps = psdict.get('https://schema.org/SalePrice') or psdict.get('https://schema.org/ListPrice')
-                variants[skuid]['price'] = int(ps['price'])
-                if 'True' in ps['valueAddedTaxIncluded']:
-                    variants[skuid]['price'] = int(ps['price']*0.84)
-                variants[skuid]['currency'] = ps['priceCurrency']
-                variants[skuid]['store'] = 'BC'
-                variants[skuid]['url'] = url
-                variants[skuid]['name'] = (jsdata['brand']['name'] + ' ' + jsdata['name'].replace('\/', '/'))
-                variants[skuid]['instock'] = 'InStock' in sku['offers']['availability']
-
-        return {'status': STATUS_OK, 'variants': variants}
+
+async def parseBC(url, httptimeout, validators=None):
+    try:
+        response, validators, unchanged = await fetch_with_validators('BC', url, httptimeout, validators, fingerprintBC)
+        if unchanged:
+            return unchanged_result(validators)
+        variants = await run_extractor(extractBC, response.text, response.url)
+        return {'status': STATUS_OK, 'variants': variants, 'validators': validators}
     except TimeoutError:
         return {'status': STATUS_TIMEOUTERROR, 'variants': None}
     except Exception:
         return {'status': STATUS_PARSINGERROR, 'variants': None}
 
 
-async def parseBD(url, httptimeout):
-    try:
-        async with curl.AsyncSession() as session:
-            response = await session.get(url, impersonate='safari15_5', timeout=httptimeout)
-            content = response.text
-            url = response.url
-
-        matches = re.search(r'dataLayer.push\((\{"event":.+?)\);', content, re.DOTALL)
-        jsdata = json.loads(matches.group(1))['ecommerce']['items'][0]
-        name = jsdata['item_brand'] + ' ' + jsdata['item_name']
-        prodid = str(crc32.new(url.encode('utf-8')).crcValue)
-        
-        variants = {}
+def extractBD(content, url):
+    matches = DATALAYER_RE.search(content)
+    jsdata = json.loads(matches.group(1))['ecommerce']['items'][0]
+    name = jsdata['item_brand'] + ' ' + jsdata['item_name']
+    prodid = str(crc32.new(url.encode('utf-8')).crcValue)
+    
+    variants = {}
+    variant_data = find_tag_attr(FORM_TAG_RE, content, 'data-nele-variant-data')
+    ldjson = None
+    if variant_data is None:
+        scripts = find_scripts(content, 'application/ld+json')
+        ldjson = scripts[0] if scripts else None
+
+    if variant_data is None and ldjson is None:
         soup = BeautifulSoup(content, 'lxml')
         res = soup.find('form', {'data-nele-variant-data': True})
-
         if res:
-            jsdata = json.loads(res.get('data-nele-variant-data'))
-            for offer in jsdata['siblings']:
-                varname = offer['variantName']
-                skuid = str(crc16.new(varname.encode('utf-8')).crcValue)
-                variants[skuid] = {}
-                variants[skuid]['variant'] = varname
-                variants[skuid]['prodid'] = prodid
-                variants[skuid]['price'] = int(offer['calculatedPrice']['unitPrice'])
-                variants[skuid]['currency'] = 'EUR'
-                variants[skuid]['store'] = 'BD'
-                variants[skuid]['url'] = url
-                variants[skuid]['name'] = name
-                variants[skuid]['instock'] = offer['available']
+            variant_data = res.get('data-nele-variant-data')
         else:
-            res = soup.find('script', {'type': 'application/ld+json'})
-            jsdata = json.loads(res.string)[0]
-            offer = jsdata['offers'][0]
-            variants['0'] = {}
-            variants['0']['variant'] = ''
-            variants['0']['prodid'] = prodid
-            variants['0']['price'] = int(offer['price'])
-            variants['0']['currency'] = offer['priceCurrency']
-            variants['0']['store'] = 'BD'
-            variants['0']['url'] = url
-            variants['0']['name'] = jsdata['brand']['name'] + ' ' + jsdata['name']
-            variants['0']['instock'] = (offer['availability'] != 'https://schema.org/OutOfStock')
-
-        return {'status': STATUS_OK, 'variants': variants}
+            ldjson = soup.find('script', {'type': 'application/ld+json'}).string
+
+    if variant_data is not None:
+        jsdata = json.loads(variant_data)
+        for offer in jsdata['siblings']:
+            varname = offer['variantName']
+            skuid = str(crc16.new(varname.encode('utf-8')).crcValue)
+            variants[skuid] = {}
+            variants[skuid]['variant'] = varname
+            variants[skuid]['prodid'] = prodid
+            variants[skuid]['price'] = int(offer['calculatedPrice']['unitPrice'])
+            variants[skuid]['currency'] = 'EUR'
+            variants[skuid]['store'] = 'BD'
+            variants[skuid]['url'] = url
+            variants[skuid]['name'] = name
+            variants[skuid]['instock'] = offer['available']
+    else:
+        jsdata = json.loads(ldjson)[0]
+        offer = jsdata['offers'][0]
+        variants['0'] = {}
+        variants['0']['variant'] = ''
+        variants['0']['prodid'] = prodid
+        variants['0']['price'] = int(offer['price'])
+        variants['0']['currency'] = offer['priceCurrency']
+        variants['0']['store'] = 'BD'
+        variants['0']['url'] = url
+        variants['0']['name'] = jsdata['brand']['name'] + ' ' + jsdata['name']
+        variants['0']['instock'] = (offer['availability'] != 'https://schema.org/OutOfStock')
+
+    return variants
+
+
+def fingerprintBD(content):
+    matches = DATALAYER_RE.search(content)
+    parts = [
+        matches.group(1) if matches else '',
+        find_tag_attr(FORM_TAG_RE, content, 'data-nele-variant-data') or '',
+        *find_scripts(content, 'application/ld+json')
+    ]
+    return ''.join(parts)
+
+
+async def parseBD(url, httptimeout, validators=None):
+    try:
+        response, validators, unchanged = await fetch_with_validators('BD', url, httptimeout, validators, fingerprintBD)
+        if unchanged:
+            return unchanged_result(validators)
+        variants = await run_extractor(extractBD, response.text, response.url)
+        return {'status': STATUS_OK, 'variants': variants, 'validators': validators}
     except TimeoutError:
         return {'status': STATUS_TIMEOUTERROR, 'variants': None}
     except Exception:
         return {'status': STATUS_PARSINGERROR, 'variants': None}
 
 
-async def parseCRC(url, httptimeout):
+def extractCRC(content, url):
     def getVarName(variant):
         tmp = []
         attrs = {x['name']: x for x in variant['attributes']}
@@ -500,107 +751,138 @@ async def parseCRC(url, httptimeout):
 
         return ', '.join(tmp)
 
+    jsdata = None
+    for script in find_scripts(content, 'application/json'):
+        try:
+            jsdata = json.loads(script)
+        except ValueError:
+            continue
+        if 'props' in jsdata:
+            break
+        jsdata = None
+
+    if jsdata is None:
+        matches = CRC_JSON_RE.search(content)
+        jsdata = json.loads(matches.group(1))
+    jsbody = jsdata['props']['pageProps']['renderGraph']['page']['components']['body'][0]
+    jsvariants = jsbody['variants']
+
+    variants = {}
+    for variant in jsvariants:
+        skuid = str(crc16.new((variant['sku']).encode('utf-8')).crcValue)
+        variants[skuid] = {}
+        variants[skuid]['variant'] = getVarName(variant)
+        variants[skuid]['prodid'] = jsbody['key']
+        variants[skuid]['price'] = int(variant['price']['current']['centAmount']/100)
+        variants[skuid]['currency'] = variant['price']['current']['currencyCode']
+        variants[skuid]['store'] = 'CRC'
+        variants[skuid]['url'] = url
+        variants[skuid]['name'] = jsbody['name']
+        variants[skuid]['instock'] = variant['stockLevel']['inStock']
+
+    return variants
+
+
+def fingerprintCRC(content):
+    return ''.join(find_scripts(content, 'application/json'))
+
+
+async def parseCRC(url, httptimeout, validators=None):
     headers = {
         'Cookie': 'countryCode=KZ; languageCode=en; currencyCode=USD'
     }
-    timeout = ClientTimeout(total=httptimeout)
     try:
-        async with ClientSession(headers=headers, timeout=timeout) as session:
-            async with session.get(url) as response:
-                content = await response.text()
-                url = str(response.url)
-
-        matches = re.search(r'type="application/json">(.+)</script>', content, re.DOTALL)
-        jsdata = json.loads(matches.group(1))
-        jsbody = jsdata['props']['pageProps']['renderGraph']['page']['components']['body'][0]
-        jsvariants = jsbody['variants']
-
-        variants = {}
-        for variant in jsvariants:
-            skuid = str(crc16.new((variant['sku']).encode('utf-8')).crcValue)
-            variants[skuid] = {}
-            variants[skuid]['variant'] = getVarName(variant)
-            variants[skuid]['prodid'] = jsbody['key']
-            variants[skuid]['price'] = int(variant['price']['current']['centAmount']/100)
-            variants[skuid]['currency'] = variant['price']['current']['currencyCode']
-            variants[skuid]['store'] = 'CRC'
-            variants[skuid]['url'] = url
-            variants[skuid]['name'] = jsbody['name']
-            variants[skuid]['instock'] = variant['stockLevel']['inStock']
-
-        return {'status': STATUS_OK, 'variants': variants}
+        response, validators, unchanged = await fetch_with_validators('CRC', url, httptimeout, validators, fingerprintCRC, headers)
+        if unchanged:
+            return unchanged_result(validators)
+        variants = await run_extractor(extractCRC, response.text, response.url)
+        return {'status': STATUS_OK, 'variants': variants, 'validators': validators}
     except TimeoutError:
         return {'status': STATUS_TIMEOUTERROR, 'variants': None}
     except Exception:
         return {'status': STATUS_PARSINGERROR, 'variants': None}
 
 
-async def parseA4C(url, httptimeout):
-    headers = {}
-    timeout = ClientTimeout(total=httptimeout)
+def extractA4C(content, url):
+    prodid = str(crc32.new(url.encode('utf-8')).crcValue)        
+    matches = A4C_PRODUCT_RE.search(content)
+    jsraw = matches.group(1)
+    jsraw = A4C_TRAILING_COMMA_RE.sub(r'\1', jsraw)
+    jsraw = A4C_KEY_RE.sub(r'"\1":', jsraw)
+    jsraw = '{' + jsraw + '}'
+    jsdata = json.loads(jsraw)
+    name = jsdata['title'].split(' - ')[0]
+    variants = {}
+    for x in jsdata['variants']:
+        skuid = str(crc16.new(str(x['id']).encode('utf-8')).crcValue)
+        variants[skuid] = {}
+        variants[skuid]['variant'] = x['title']
+        variants[skuid]['prodid'] = prodid
+        variants[skuid]['price'] = int(x['price']/100)
+        variants[skuid]['currency'] = 'EUR'
+        variants[skuid]['store'] = 'A4C'
+        variants[skuid]['url'] = url
+        variants[skuid]['name'] = name
+        variants[skuid]['instock'] = x['available']
+
+    return variants
+
+
+def fingerprintA4C(content):
+    matches = A4C_PRODUCT_RE.search(content)
+    return matches.group(1) if matches else None
+
+
+async def parseA4C(url, httptimeout, validators=None):
     try:
-        async with ClientSession(headers=headers, timeout=timeout) as session:
-            async with session.get(url) as response:
-                content = await response.text()
-                url = str(response.url)
-
-        prodid = str(crc32.new(url.encode('utf-8')).crcValue)        
-        matches = re.search(r'_ReStockConfig.product = {(.+?)};', content, re.DOTALL)
-        jsraw = matches.group(1)
-        jsraw = re.sub(r',(\s*[}\]])', r'\1', jsraw)
-        jsraw = re.sub(r'(\w+)\s*:', r'"\1":', jsraw)
-        jsraw = '{' + jsraw + '}'
-        jsdata = json.loads(jsraw)
-        name = jsdata['title'].split(' - ')[0]
-        variants = {}
-        for x in jsdata['variants']:
-            skuid = str(crc16.new(str(x['id']).encode('utf-8')).crcValue)
-            variants[skuid] = {}
-            variants[skuid]['variant'] = x['title']
-            variants[skuid]['prodid'] = prodid
-            variants[skuid]['price'] = int(x['price']/100)
-            variants[skuid]['currency'] = 'EUR'
-            variants[skuid]['store'] = 'A4C'
-            variants[skuid]['url'] = url
-            variants[skuid]['name'] = name
-            variants[skuid]['instock'] = x['available']
-
-        return {'status': STATUS_OK, 'variants': variants}
+        response, validators, unchanged = await fetch_with_validators('A4C', url, httptimeout, validators, fingerprintA4C)
+        if unchanged:
+            return unchanged_result(validators)
+        variants = await run_extractor(extractA4C, response.text, response.url)
+        return {'status': STATUS_OK, 'variants': variants, 'validators': validators}
     except TimeoutError:
         return {'status': STATUS_TIMEOUTERROR, 'variants': None}
     except Exception:
         return {'status': STATUS_PARSINGERROR, 'variants': None}
 
 
-async def parseLG(url, httptimeout):
-    headers = {}
-    timeout = ClientTimeout(total=httptimeout)
-    try:
-        async with ClientSession(headers=headers, timeout=timeout) as session:
-            async with session.get(url) as response:
-                content = await response.text()
-                url = str(response.url)
-
-        def findData(tag):
-            return tag.name == 'article' and tag.get('id') == 'product-new'
+def extractLG(content, url):
+    def findData(tag):
+        return tag.name == 'article' and tag.get('id') == 'product-new'
 
+    datajson = find_tag_attr(ARTICLE_TAG_RE, content, 'data-json', id='product-new')
+    if datajson is None:
         soup = BeautifulSoup(content, 'lxml')
         res = soup.find_all(findData)
-        jsdata = json.loads(res[0]['data-json'])
-        variants = {}
-        for x in jsdata['options']:
-            skuid = str(x['sourceId'])
-            variants[skuid] = {}
-            variants[skuid]['variant'] = (', ').join(sorted(x['attributes'].values()))
-            variants[skuid]['prodid'] = str(jsdata['originId'])
-            variants[skuid]['price'] = int(x['price']['price0'])
-            variants[skuid]['currency'] = 'USD'
-            variants[skuid]['store'] = 'LG'
-            variants[skuid]['url'] = url
-            variants[skuid]['name'] = jsdata['title']
-            variants[skuid]['instock'] = x['quantity'] > 0
+        datajson = res[0]['data-json']
+    jsdata = json.loads(datajson)
+    variants = {}
+    for x in jsdata['options']:
+        skuid = str(x['sourceId'])
+        variants[skuid] = {}
+        variants[skuid]['variant'] = (', ').join(sorted(x['attributes'].values()))
+        variants[skuid]['prodid'] = str(jsdata['originId'])
+        variants[skuid]['price'] = int(x['price']['price0'])
+        variants[skuid]['currency'] = 'USD'
+        variants[skuid]['store'] = 'LG'
+        variants[skuid]['url'] = url
+        variants[skuid]['name'] = jsdata['title']
+        variants[skuid]['instock'] = x['quantity'] > 0
+
+    return variants
+
 
-        return {'status': STATUS_OK, 'variants': variants}
+def fingerprintLG(content):
+    return find_tag_attr(ARTICLE_TAG_RE, content, 'data-json', id='product-new')
+
+
+async def parseLG(url, httptimeout, validators=None):
+    try:
+        response, validators, unchanged = await fetch_with_validators('LG', url, httptimeout, validators, fingerprintLG)
+        if unchanged:
+            return unchanged_result(validators)
+        variants = await run_extractor(extractLG, response.text, response.url)
+        return {'status': STATUS_OK, 'variants': variants, 'validators': validators}
     except TimeoutError:
         return {'status': STATUS_TIMEOUTERROR, 'variants': None}
     except Exception:
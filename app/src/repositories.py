@@ -1,15 +1,145 @@
-from time import time
+import asyncio
+import logging
+from collections import Counter, OrderedDict, namedtuple
+from functools import lru_cache
+from datetime import datetime, timezone
+from time import monotonic, time
 from typing import AsyncIterator
 
-from pymongo import UpdateOne
+from pymongo import ASCENDING, DESCENDING, DeleteOne, IndexModel, InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
 from aiogram.types import User as TgUser
 
 import parsing
-from constants import STATUS_TIMEOUTERROR
-from models import Product, Sku, User
+from constants import STATUS_OK, STATUS_TIMEOUTERROR, STATUS_UNCHANGED
+from models import Broadcast, ChangeEvent, PriceHistory, Product, Sku, User
 from settings import AppSettings
 
 
+INDEX_NOT_FOUND = 27
+
+
+async def ensure_indexes(collection, indexes: list[IndexModel]) -> list[str]:
+    await collection.create_indexes(indexes)
+    existing = await collection.index_information()
+    missing = [index.document['name'] for index in indexes if index.document['name'] not in existing]
+    for name in missing:
+        logging.error(f'Index {name} is missing on {collection.name}')
+    return missing
+
+
+def fenced(query: dict, token: int) -> dict:
+    # Documents stamped by a newer leader are out of reach for a stale one
+    return {**query, 'leader_token': {'$not': {'$gt': token}}}
+
+
+def describe_plan(explanation: dict) -> str:
+    planner = explanation.get('queryPlanner', {})
+    plan = planner.get('winningPlan', {})
+    plan = plan.get('queryPlan', plan)
+    stages = []
+    while plan:
+        stage = plan.get('stage', '?')
+        if plan.get('indexName'):
+            stage += f'({plan["indexName"]})'
+        stages.append(stage)
+        plan = plan.get('inputStage') or (plan.get('inputStages') or [None])[0]
+
+    stats = explanation.get('executionStats', {})
+    return (
+        ' > '.join(stages)
+        + f', returned {stats.get("nReturned", "?")}'
+        + f', examined {stats.get("totalDocsExamined", "?")} docs'
+        + f' / {stats.get("totalKeysExamined", "?")} keys'
+        + f', {stats.get("executionTimeMillis", "?")} ms'
+    )
+
+
+async def explain(collection, query: dict, sort=None) -> str:
+    cursor = collection.find(query)
+    if sort is not None:
+        cursor = cursor.sort(sort)
+    return describe_plan(await cursor.explain())
+
+
+@lru_cache(maxsize=None)
+def row_type(fields: tuple[str, ...]) -> type:
+    return namedtuple('Row', ['doc_id' if field == '_id' else field for field in fields])
+
+
+async def find_rows(collection, query: dict, fields: tuple[str, ...], sort=None, batch_size: int = 1000) -> AsyncIterator[tuple]:
+    # Streams projected documents as compact tuples, one batch in memory at a time
+    row = row_type(fields)
+    projection = {field: 1 for field in fields}
+    if '_id' not in fields:
+        projection['_id'] = 0
+    cursor = collection.find(query, projection, batch_size=batch_size)
+    if sort is not None:
+        cursor = cursor.sort(sort)
+    async for document in cursor:
+        yield row(*(document.get(field) for field in fields))
+
+
+class BulkWriter:
+    def __init__(self, collection, batch_size: int = 1000, flush_interval: float = 5.0):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.failed = 0
+        self._requests = []
+        self._labels = []
+        self._last_flush = monotonic()
+        self._lock = asyncio.Lock()
+        self._flusher: asyncio.Task | None = None
+
+    async def __aenter__(self) -> 'BulkWriter':
+        self._flusher = asyncio.create_task(self._flush_periodically())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+
+    async def _flush_periodically(self):
+        # Pending operations of a quiet writer are not held until the next add()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if monotonic() - self._last_flush >= self.flush_interval:
+                # Shielded so closing the writer cannot cancel a bulk write halfway
+                await asyncio.shield(self.flush())
+
+    async def add(self, request, label: str | None = None):
+        self._requests.append(request)
+        self._labels.append(label)
+        if len(self._requests) >= self.batch_size or monotonic() - self._last_flush >= self.flush_interval:
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            requests, labels = self._requests, self._labels
+            self._requests, self._labels = [], []
+            self._last_flush = monotonic()
+            if not requests:
+                return
+
+            try:
+                await self.collection.bulk_write(requests, ordered=False)
+                self.written += len(requests)
+            except BulkWriteError as e:
+                write_errors = e.details.get('writeErrors', [])
+                self.written += len(requests) - len(write_errors)
+                self.failed += len(write_errors)
+                for error in write_errors:
+                    logging.error(f'Error writing {labels[error["index"]]}: {error["errmsg"]}')
+            except PyMongoError as e:
+                self.failed += len(requests)
+                logging.error(f'Bulk write of {len(requests)} operations to {self.collection.name} failed: {e}')
+
+
 class SettingsRepository:
     def __init__(self, database):
         self.collection = database.settings
@@ -22,19 +152,78 @@ class SettingsRepository:
 
 
 class SkuRepository:
+    INDEXES = [
+        IndexModel([('chat_id', ASCENDING)], name='chat_id'),
+        IndexModel([('store_prodid', ASCENDING), ('enable', ASCENDING)], name='store_prodid_enable'),
+        IndexModel([('lastcheckts', ASCENDING)], name='lastcheckts'),
+        IndexModel([('lastgoodts', ASCENDING)], name='lastgoodts'),
+        IndexModel([('store', ASCENDING)], name='store'),
+    ]
+    # Change markers moved to the outbox collection, due checks to the schedule collection
+    OBSOLETE_INDEXES = ['price_prev', 'instock_prev', 'enable_lastcheckts']
+    ROW_BATCH_SIZE = 5000
+    FIND_BATCH_SIZE = 500
+    LIST_FIELDS = {'name': 1, 'variant': 1, 'store': 1, 'price': 1, 'currency': 1, 'instock': 1}
+    LIST_SORTS = ('name', 'store', 'price', 'instock')
+
     def __init__(self, database):
         self.collection = database.sku
+        self.users = database.users
+        self.schedule = database.schedule
+
+    async def ensure_indexes(self) -> list[str]:
+        return await ensure_indexes(self.collection, self.INDEXES)
+
+    async def migrate(self):
+        for name in self.OBSOLETE_INDEXES:
+            try:
+                await self.collection.drop_index(name)
+            except OperationFailure as e:
+                # Already gone, possibly dropped by another replica
+                if e.code != INDEX_NOT_FOUND:
+                    raise
+
+    async def _adjust_user_counters(self, documents: list[dict], sign: int):
+        counts = Counter((document['chat_id'], document['store']) for document in documents)
+        increments = {}
+        for (chat_id, store), count in counts.items():
+            inc = increments.setdefault(chat_id, {'sku_count': 0, 'sku_version': 1})
+            inc['sku_count'] += sign * count
+            inc[f'store_counts.{store}'] = sign * count
+
+        if increments:
+            await self.users.bulk_write(
+                [UpdateOne({'_id': chat_id}, {'$inc': inc}) for chat_id, inc in increments.items()],
+                ordered=False
+            )
+
+    async def _delete_counted(self, query: dict) -> int:
+        # One document at a time so only what this call removed is counted, a racing delete counts its own
+        deleted = []
+        async for document in self.collection.find(query, {'_id': 1}):
+            document = await self.collection.find_one_and_delete({'_id': document['_id']}, {'chat_id': 1, 'store': 1})
+            if document is not None:
+                deleted.append(document)
+        await self._adjust_user_counters(deleted, -1)
+        return len(deleted)
+
+    async def explain(self, query: dict, sort=None) -> str:
+        return await explain(self.collection, query, sort)
 
     async def exists(self, doc_id: str) -> bool:
         return await self.collection.find_one({'_id': doc_id}) is not None
 
     async def find(self, query: dict | None = None, sort=None) -> AsyncIterator[Sku]:
-        cursor = self.collection.find(query or {})
+        cursor = self.collection.find(query or {}, batch_size=self.FIND_BATCH_SIZE)
         if sort is not None:
             cursor = cursor.sort(sort)
         async for document in cursor:
             yield Sku.from_document(document)
 
+    async def find_rows(self, query: dict, fields: tuple[str, ...], sort=None) -> AsyncIterator[tuple]:
+        async for row in find_rows(self.collection, query, fields, sort, self.ROW_BATCH_SIZE):
+            yield row
+
     async def count(self, query: dict | None = None) -> int:
         return await self.collection.count_documents(query or {})
 
@@ -42,7 +231,10 @@ class SkuRepository:
         return await self.collection.distinct(field, query or {})
 
     async def insert(self, sku: Sku):
-        return await self.collection.insert_one(sku.to_json())
+        result = await self.collection.insert_one(sku.to_json())
+        await self._adjust_user_counters([{'chat_id': sku.chat_id, 'store': sku.store}], 1)
+        await self.schedule.bulk_write([ScheduleRepository.wake_request(sku.store_prodid, int(time()))])
+        return result
 
     async def save(self, sku: Sku):
         data = sku.to_json()
@@ -52,15 +244,26 @@ class SkuRepository:
             {'$set': data}
         )
 
+    def save_request(self, sku: Sku) -> UpdateOne:
+        data = sku.to_json()
+        data.pop('_id')
+        return UpdateOne({'_id': sku.doc_id}, {'$set': data})
+
+    def bulk_writer(self) -> BulkWriter:
+        return BulkWriter(self.collection)
+
     async def delete(self, doc_id: str) -> bool:
-        result = await self.collection.delete_one({'_id': doc_id})
-        return result.deleted_count == 1
+        document = await self.collection.find_one_and_delete({'_id': doc_id}, {'chat_id': 1, 'store': 1})
+        if document is None:
+            return False
+        await self._adjust_user_counters([document], -1)
+        return True
 
     async def delete_many(self, query: dict):
-        return await self.collection.delete_many(query)
+        return await self._delete_counted(query)
 
     async def delete_by_ids(self, chat_id: str, doc_ids: list[str]):
-        return await self.collection.delete_many({
+        return await self._delete_counted({
             '_id': {'$in': doc_ids},
             'chat_id': chat_id
         })
@@ -68,52 +271,155 @@ class SkuRepository:
     async def update_many(self, query: dict, update: dict):
         return await self.collection.update_many(query, update)
 
-    async def clear_notifications(self, doc_ids: list[str]):
-        if not doc_ids:
+    async def list_page(
+        self,
+        chat_id: str,
+        filters: dict,
+        sort: str = 'name',
+        descending: bool = False,
+        after: list | None = None,
+        limit: int = 50
+    ) -> tuple[list[dict], list | None]:
+        query = {'chat_id': chat_id, **filters}
+        if after is not None:
+            # Keyset pagination: continue strictly after the last (sort value, _id) pair
+            value, doc_id = after
+            op = '$lt' if descending else '$gt'
+            query['$or'] = [{sort: {op: value}}, {sort: value, '_id': {op: doc_id}}]
+        direction = DESCENDING if descending else ASCENDING
+        cursor = self.collection.find(query, self.LIST_FIELDS).sort([(sort, direction), ('_id', direction)]).limit(limit + 1)
+        documents = await cursor.to_list()
+        if len(documents) <= limit:
+            return documents, None
+        documents = documents[:limit]
+        return documents, [documents[-1][sort], documents[-1]['_id']]
+
+
+class ProductCache:
+    def __init__(self, max_entries: int = 20000, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[int, int, Product]] = OrderedDict()
+        self._urls: dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, url: str, timestamp_expired: int) -> Product | None:
+        entry = self._entries.get(url)
+        if entry is None or entry[0] <= timestamp_expired:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(url)
+        self.hits += 1
+        return entry[2]
+
+    def get_url(self, store_prodid: str) -> str | None:
+        return self._urls.get(store_prodid)
+
+    def put(self, url: str, variants: dict | None, timestamp: int) -> Product:
+        self._discard(url)
+        product = Product(data=variants, source='cache')
+        size = len(url) + len(str(variants))
+        self._entries[url] = (timestamp, size, product)
+        self.bytes += size
+        if product.store:
+            self._urls[product.store + '_' + product.id] = url
+
+        while self._entries and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+            self._discard(next(iter(self._entries)))
+        return product
+
+    def _discard(self, url: str):
+        entry = self._entries.pop(url, None)
+        if entry is None:
             return
-        
-        requests = [
-            UpdateOne(
-                {'_id': doc_id},
-                {'$set': {'price_prev': None, 'instock_prev': None}}
-            )
-            for doc_id in doc_ids
-        ]
-        await self.collection.bulk_write(requests)
+        _, size, product = entry
+        self.bytes -= size
+        if product.store:
+            self._urls.pop(product.store + '_' + product.id, None)
+
 
 class ProductRepository:
     cache_lifetime = 0
     http_timeout = 0
+    retention = 0
+
+    INDEXES = [
+        IndexModel([('url', ASCENDING), ('timestamp', ASCENDING)], name='url_timestamp'),
+    ]
+    TTL_INDEX = 'updated_at_ttl'
 
     def __init__(self, database):
+        self.database = database
         self.collection = database.skucache
+        self.memory = ProductCache()
+        self.unchanged = 0
 
     @classmethod
-    def configure(cls, cache_lifetime: int, http_timeout: int):
+    def configure(cls, cache_lifetime: int, http_timeout: int, retention: int):
         cls.cache_lifetime = cache_lifetime
         cls.http_timeout = http_timeout
+        # Entries outlive their freshness so the next check can still use their validators
+        cls.retention = max(cache_lifetime, retention)
 
     async def get(self, store: str, url: str) -> Product:
         timestamp_expired = int(time()) - self.cache_lifetime * 60
-        document = await self.collection.find_one({
-            'url': url,
-            'timestamp': {'$gt': timestamp_expired}
-        })
-        if document:
-            return Product(data=document['variants'], source='cache')
+        product = self.memory.get(url, timestamp_expired)
+        if product is not None:
+            return product
 
+        document = await self.collection.find_one({'url': url}, sort=[('timestamp', DESCENDING)])
+        if document and document['timestamp'] > timestamp_expired:
+            return self.memory.put(url, document['variants'], document['timestamp'])
+
+        validators = document.get('validators') if document and document['variants'] else None
         parse_function = getattr(parsing, 'parse' + store)
-        result = await parse_function(url, self.http_timeout)
+        result = await parse_function(url, self.http_timeout, validators)
+        if result['status'] == STATUS_UNCHANGED:
+            self.unchanged += 1
+            result = {'status': STATUS_OK, 'variants': document['variants'], 'validators': result['validators']}
         await self._cache(url, result)
-        return Product(data=result['variants'], source='web')
+        return Product(data=result['variants'], source='web', status=result['status'])
 
     async def get_url(self, store: str, product_id: str) -> str | None:
+        url = self.memory.get_url(store + '_' + product_id)
+        if url:
+            return url
         document = await self.collection.find_one({'_id': store + '_' + product_id})
         return document['url'] if document else None
 
-    async def clear_sku_cache(self):
-        timestamp_expired = int(time()) - self.cache_lifetime * 60
-        await self.collection.delete_many({'timestamp': {'$lt': timestamp_expired}})
+    async def migrate(self):
+        # Entries written before the TTL index existed only carry the integer timestamp
+        await self.collection.update_many(
+            {'updated_at': {'$exists': False}},
+            [{'$set': {'updated_at': {'$toDate': {'$multiply': ['$timestamp', 1000]}}}}]
+        )
+
+    async def ensure_indexes(self) -> list[str]:
+        expire_after = self.retention * 60
+        existing = await self.collection.index_information()
+        ttl_index = existing.get(self.TTL_INDEX)
+        if ttl_index is None:
+            await self.collection.create_index(
+                [('updated_at', ASCENDING)],
+                name=self.TTL_INDEX,
+                expireAfterSeconds=expire_after
+            )
+        elif ttl_index.get('expireAfterSeconds') != expire_after:
+            await self.database.command(
+                'collMod',
+                self.collection.name,
+                index={'name': self.TTL_INDEX, 'expireAfterSeconds': expire_after}
+            )
+
+        return await ensure_indexes(self.collection, self.INDEXES)
+
+    async def explain(self, query: dict, sort=None) -> str:
+        return await explain(self.collection, query, sort)
 
     async def _cache(self, url: str, result: dict):
         if result['status'] == STATUS_TIMEOUTERROR:
@@ -128,15 +434,31 @@ class ProductRepository:
 
         data = {
             'variants': variants,
+            'validators': result.get('validators'),
             'timestamp': int(time()),
+            'updated_at': datetime.now(timezone.utc),
             'url': url
         }
         await self.collection.update_one(query, {'$set': data}, upsert=True)
+        self.memory.put(url, variants, data['timestamp'])
 
 
 class UserRepository:
+    INDEXES = [
+        IndexModel([('enable', ASCENDING), ('sku_count', ASCENDING)], name='enable_sku_count'),
+        IndexModel([('sku_count', DESCENDING)], name='sku_count'),
+        IndexModel([('store_counts.$**', ASCENDING)], name='store_counts'),
+    ]
+
     def __init__(self, database):
         self.collection = database.users
+        self.skus = database.sku
+
+    async def ensure_indexes(self) -> list[str]:
+        return await ensure_indexes(self.collection, self.INDEXES)
+
+    async def explain(self, query: dict, sort=None) -> str:
+        return await explain(self.collection, query, sort)
 
     async def find(self, query: dict | None = None) -> AsyncIterator[User]:
         cursor = self.collection.find(query or {})
@@ -158,24 +480,7 @@ class UserRepository:
         await self.collection.update_one({'_id': user.id}, {'$set': data}, upsert=True)
 
     async def find_by_store(self, store: str) -> AsyncIterator[User]:
-        cursor = await self.collection.aggregate([
-            {
-                '$lookup':
-                {
-                    'from': 'sku',
-                    'localField': '_id',
-                    'foreignField': 'chat_id',
-                    'as': 'matched_skus'
-                }
-            },
-            {
-                '$match':
-                {
-                    'matched_skus.store': store,
-                    'enable': True
-                }
-            }
-        ])
+        cursor = self.collection.find({'enable': True, f'store_counts.{store}': {'$gt': 0}})
         async for document in cursor:
             yield User.from_document(document)
 
@@ -185,30 +490,7 @@ class UserRepository:
             await self.save(new_user)
 
     async def top_users(self, limit: int) -> AsyncIterator[User]:
-        cursor = await self.collection.aggregate([
-            {
-                '$lookup':
-                {
-                    'from': "sku",
-                    'localField': "_id",
-                    'foreignField': "chat_id",
-                    'as': "sku_docs"
-                }
-            },
-            {
-                '$addFields': { 'sku_count': { '$size': "$sku_docs" } }
-            },
-            {
-                '$match': { 'sku_count': { '$ne': 0 } }
-            },
-            {
-                '$sort': { "sku_count": -1 }
-            },
-            {
-                '$limit': limit
-            }
-        ])
-        
+        cursor = self.collection.find({'sku_count': {'$gt': 0}}).sort('sku_count', DESCENDING).limit(limit)
         async for document in cursor:
             yield User.from_document(document)
 
@@ -216,29 +498,315 @@ class UserRepository:
         return await self.collection.count_documents(query or {})
 
     async def count_with_sku(self) -> int:
-        cursor = await self.collection.aggregate([
-            {
-                '$match': {'enable': True}
-            },
+        return await self.collection.count_documents({'enable': True, 'sku_count': {'$gt': 0}})
+
+    async def reconcile_counters(self) -> int:
+        # Snapshot first: every counter $inc also bumps sku_version, so a write that lands after the
+        # snapshot makes the conditional update below miss and the user is left for the next run
+        observed = {}
+        async for document in self.collection.find({}, {'sku_count': 1, 'store_counts': 1, 'sku_version': 1}):
+            observed[document['_id']] = document
+
+        expected = {}
+        cursor = await self.skus.aggregate([
+            {'$group': {'_id': {'chat_id': '$chat_id', 'store': '$store'}, 'count': {'$sum': 1}}}
+        ])
+        async for document in cursor:
+            counters = expected.setdefault(document['_id']['chat_id'], {'sku_count': 0, 'store_counts': {}})
+            counters['sku_count'] += document['count']
+            counters['store_counts'][document['_id']['store']] = document['count']
+
+        empty = {'sku_count': 0, 'store_counts': {}}
+        writer = BulkWriter(self.collection)
+        async with writer:
+            for chat_id, document in observed.items():
+                counters = expected.get(chat_id, empty)
+                store_counts = {store: count for store, count in document.get('store_counts', {}).items() if count}
+                if document.get('sku_count', 0) != counters['sku_count'] or store_counts != counters['store_counts']:
+                    await writer.add(
+                        UpdateOne({'_id': chat_id, 'sku_version': document.get('sku_version')}, {'$set': counters}),
+                        chat_id
+                    )
+        return writer.written + writer.failed
+
+    async def update_many(self, query: dict, update: dict):
+        return await self.collection.update_many(query, update, upsert=True)
+
+    async def find_rows(self, query: dict, fields: tuple[str, ...]) -> AsyncIterator[tuple]:
+        async for row in find_rows(self.collection, query, fields):
+            yield row
+
+    async def find_ids(self, query: dict, after_id: str | None = None, limit: int = 500) -> list[str]:
+        if after_id is not None:
+            query = {**query, '_id': {'$gt': after_id}}
+        cursor = self.collection.find(query, {'_id': 1}).sort('_id', ASCENDING).limit(limit)
+        return [document['_id'] async for document in cursor]
+
+    async def sku_version(self, chat_id: str) -> int:
+        document = await self.collection.find_one({'_id': chat_id}, {'sku_version': 1})
+        return document.get('sku_version', 0) if document else 0
+
+    def touch_request(self, chat_id: str) -> UpdateOne:
+        return UpdateOne({'_id': chat_id}, {'$inc': {'sku_version': 1}})
+
+    def broadcast_request(self, chat_id: str, text_hash: str) -> UpdateOne:
+        return UpdateOne({'_id': chat_id}, {'$addToSet': {'broadcasts': text_hash}})
+
+    def bulk_writer(self) -> BulkWriter:
+        return BulkWriter(self.collection)
+
+
+class BroadcastRepository:
+    INDEXES = [
+        IndexModel([('status', ASCENDING)], name='status'),
+    ]
+
+    def __init__(self, database):
+        self.collection = database.broadcasts
+
+    async def ensure_indexes(self) -> list[str]:
+        return await ensure_indexes(self.collection, self.INDEXES)
+
+    async def insert(self, broadcast: Broadcast):
+        result = await self.collection.insert_one(broadcast.to_json())
+        broadcast.doc_id = result.inserted_id
+
+    async def save(self, broadcast: Broadcast, token: int) -> bool:
+        result = await self.collection.update_one(
+            fenced({'_id': broadcast.doc_id}, token),
+            {'$set': {**broadcast.to_json(), 'leader_token': token}}
+        )
+        return result.matched_count == 1
+
+    async def find_running(self) -> AsyncIterator[Broadcast]:
+        async for document in self.collection.find({'status': 'running'}).sort('created_at', ASCENDING):
+            yield Broadcast.from_document(document)
+
+
+
+class OutboxRepository:
+    INDEXES = [
+        IndexModel([('chat_id', ASCENDING), ('_id', ASCENDING)], name='chat_id'),
+    ]
+
+    def __init__(self, database):
+        self.collection = database.outbox
+
+    async def ensure_indexes(self) -> list[str]:
+        return await ensure_indexes(self.collection, self.INDEXES)
+
+    async def explain(self, query: dict, sort=None) -> str:
+        return await explain(self.collection, query, sort)
+
+    def insert_request(self, event: ChangeEvent) -> InsertOne:
+        return InsertOne(event.to_json())
+
+    def bulk_writer(self) -> BulkWriter:
+        return BulkWriter(self.collection)
+
+    async def next_batch(self, limit: int, token: int) -> dict[str, list[ChangeEvent]]:
+        query = {'next_attempt_at': {'$not': {'$gt': int(time())}}}
+        cursor = self.collection.find(query, {'_id': 1}).sort('_id', ASCENDING).limit(limit)
+        ids = [document['_id'] async for document in cursor]
+        if not ids:
+            return {}
+
+        # Stamp the batch with the lease token, a newer leader takes it over by stamping it again
+        await self.collection.update_many(fenced({'_id': {'$in': ids}}, token), {'$set': {'leader_token': token}})
+        batch = {}
+        async for document in self.collection.find({'_id': {'$in': ids}, 'leader_token': token}).sort('_id', ASCENDING):
+            event = ChangeEvent(document)
+            batch.setdefault(event.chat_id, []).append(event)
+        return batch
+
+    async def ack(self, events: list[ChangeEvent], token: int):
+        await self.collection.delete_many({'_id': {'$in': [event.doc_id for event in events]}, 'leader_token': token})
+
+    async def retry(self, events: list[ChangeEvent], next_attempt_at: int, token: int):
+        await self.collection.update_many(
+            {'_id': {'$in': [event.doc_id for event in events]}, 'leader_token': token},
+            {'$inc': {'attempts': 1}, '$set': {'next_attempt_at': next_attempt_at}}
+        )
+
+    async def count(self) -> int:
+        return await self.collection.estimated_document_count()
+
+
+class ScheduleRepository:
+    INDEXES = [
+        IndexModel([('next_check_at', ASCENDING)], name='next_check_at'),
+    ]
+    INITIAL_CHANGE_RATE = 0.5
+
+    def __init__(self, database):
+        self.collection = database.schedule
+        self.skus = database.sku
+
+    async def ensure_indexes(self) -> list[str]:
+        return await ensure_indexes(self.collection, self.INDEXES)
+
+    async def explain(self, query: dict, sort=None) -> str:
+        return await explain(self.collection, query, sort)
+
+    @classmethod
+    def wake_request(cls, store_prodid: str, next_check_at: int) -> UpdateOne:
+        return UpdateOne(
+            {'_id': store_prodid},
             {
-                '$lookup':
-                {
-                    'from': 'sku',
-                    'localField': '_id',
-                    'foreignField': 'chat_id',
-                    'as': 'sku_docs'
+                '$min': {'next_check_at': next_check_at},
+                '$setOnInsert': {
+                    'store': store_prodid.split('_', 1)[0],
+                    'change_rate': cls.INITIAL_CHANGE_RATE,
+                    'subscribers': 0
                 }
             },
+            upsert=True
+        )
+
+    async def wake(self, store_prodids: list[str], now: int):
+        if store_prodids:
+            await self.collection.bulk_write([self.wake_request(store_prodid, now) for store_prodid in store_prodids])
+
+    async def claim(self, owner: str, now: int, stores: list[str], lease_seconds: int, limit: int) -> dict[str, dict]:
+        claimed = {}
+        for _ in range(limit):
+            document = await self.collection.find_one_and_update(
+                {
+                    'next_check_at': {'$lte': now},
+                    'store': {'$in': stores},
+                    'lease_expires': {'$not': {'$gt': now}}
+                },
+                {'$set': {'lease_owner': owner, 'lease_expires': now + lease_seconds}},
+                sort=[('next_check_at', ASCENDING)],
+                return_document=ReturnDocument.AFTER
+            )
+            if document is None:
+                break
+            claimed[document['_id']] = document
+        return claimed
+
+    async def renew(self, store_prodids: list[str], owner: str, lease_expires: int):
+        await self.collection.update_many(
+            {'_id': {'$in': store_prodids}, 'lease_owner': owner},
+            {'$set': {'lease_expires': lease_expires}}
+        )
+
+    async def release(self, store_prodids: list[str], owner: str):
+        await self.collection.update_many(
+            {'_id': {'$in': store_prodids}, 'lease_owner': owner},
+            {'$unset': {'lease_owner': '', 'lease_expires': ''}}
+        )
+
+    def reschedule_request(
+        self,
+        store_prodid: str,
+        owner: str,
+        now: int,
+        next_check_at: int,
+        change_rate: float,
+        subscribers: int
+    ) -> UpdateOne:
+        # Matching on the owner drops results of a worker whose lease was already taken over
+        return UpdateOne(
+            {'_id': store_prodid, 'lease_owner': owner},
             {
-                '$match': { 'sku_docs.0': { '$exists': True } }
-            },
-            {
-                '$count': 'count'
+                '$set': {
+                    'last_check_at': now,
+                    'next_check_at': next_check_at,
+                    'change_rate': change_rate,
+                    'subscribers': subscribers
+                },
+                '$unset': {'lease_owner': '', 'lease_expires': ''}
             }
+        )
+
+    def bulk_writer(self) -> BulkWriter:
+        return BulkWriter(self.collection)
+
+    async def delete_many(self, store_prodids: list[str], owner: str):
+        if store_prodids:
+            await self.collection.delete_many({'_id': {'$in': store_prodids}, 'lease_owner': owner})
+
+    async def count_due(self, now: int) -> int:
+        return await self.collection.count_documents({'next_check_at': {'$lte': now}})
+
+    async def count_leased(self, now: int) -> int:
+        return await self.collection.count_documents({'lease_expires': {'$gt': now}})
+
+    async def sync(self) -> int:
+        expected = {}
+        cursor = await self.skus.aggregate([
+            {'$match': {'enable': True}},
+            {'$group': {'_id': '$store_prodid', 'lastcheckts': {'$min': '$lastcheckts'}}}
         ])
-        result = await cursor.to_list(length=1)
-        return result[0]['count'] if result else 0
-    
-    async def update_many(self, query: dict, update: dict):
-        return await self.collection.update_many(query, update, upsert=True)
+        async for document in cursor:
+            expected[document['_id']] = document['lastcheckts']
+
+        existing = set(await self.collection.distinct('_id'))
+        writer = BulkWriter(self.collection)
+        async with writer:
+            for store_prodid, lastcheckts in expected.items():
+                if store_prodid not in existing:
+                    await writer.add(self.wake_request(store_prodid, lastcheckts), store_prodid)
+            for store_prodid in existing - expected.keys():
+                await writer.add(DeleteOne({'_id': store_prodid}), store_prodid)
+        return writer.written + writer.failed
+
+
+class PriceHistoryRepository:
+    INDEXES = [
+        IndexModel([('key', ASCENDING), ('month', ASCENDING)], name='key_month'),
+        IndexModel([('expire_at', ASCENDING)], name='expire_at_ttl', expireAfterSeconds=0),
+    ]
+    # One document per variant and month, capped so a flapping price cannot grow it unbounded
+    MAX_POINTS = 500
+    RETENTION_DAYS = 400
+
+    def __init__(self, database):
+        self.collection = database.price_history
 
+    async def ensure_indexes(self) -> list[str]:
+        return await ensure_indexes(self.collection, self.INDEXES)
+
+    def record_request(self, variant, timestamp: int) -> UpdateOne:
+        key = variant.store + '_' + variant.prodid + '_' + variant.id
+        month = datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y%m')
+        return UpdateOne(
+            {'_id': key + '_' + month},
+            {
+                '$setOnInsert': {
+                    'key': key,
+                    'month': month,
+                    'name': variant.name,
+                    'variant': variant.variant,
+                    'currency': variant.currency,
+                    'expire_at': datetime.fromtimestamp(timestamp + self.RETENTION_DAYS * 24 * 3600, timezone.utc)
+                },
+                '$push': {'points': {'$each': [[timestamp, variant.price, variant.instock]], '$slice': -self.MAX_POINTS}}
+            },
+            upsert=True
+        )
+
+    async def record(self, variant, timestamp: int):
+        # History is per variant, so a new subscriber only adds a point when the price or stock moved
+        key = variant.store + '_' + variant.prodid + '_' + variant.id
+        latest = await self.collection.find_one(
+            {'key': key},
+            {'points': {'$slice': -1}},
+            sort=[('month', DESCENDING)]
+        )
+        if latest and latest.get('points') and latest['points'][-1][1:] == [variant.price, variant.instock]:
+            return
+        await self.collection.bulk_write([self.record_request(variant, timestamp)])
+
+    def bulk_writer(self) -> BulkWriter:
+        return BulkWriter(self.collection)
+
+    async def get(self, store: str, prodid: str, skuid: str, since: int) -> PriceHistory:
+        month = datetime.fromtimestamp(since, timezone.utc).strftime('%Y%m')
+        # The month before the window holds the price in effect at its start
+        cursor = self.collection.find({'key': f'{store}_{prodid}_{skuid}', 'month': {'$lt': month}}).sort('month', DESCENDING).limit(1)
+        documents = await cursor.to_list()
+        cursor = self.collection.find({'key': f'{store}_{prodid}_{skuid}', 'month': {'$gte': month}}).sort('month', ASCENDING)
+        documents += await cursor.to_list()
+        return PriceHistory(documents)
@@ -11,6 +11,8 @@ class StoreSettings(BaseModel):
     url_regex: str
     active: bool
     price_threshold: float
+    concurrency: int = 1
+    request_delay: float | None = None
 
 
 class AppSettings(BaseModel):
@@ -27,6 +29,7 @@ class AppSettings(BaseModel):
     error_max_days: int = Field(alias='ERRORMAXDAYS')
     max_items_per_user: int = Field(alias='MAXITEMSPERUSER')
     check_interval: int = Field(alias='CHECKINTERVAL')
+    max_check_interval: int = Field(default=24 * 60, alias='MAXCHECKINTERVAL')
     log_chat_id: int | None = Field(alias='LOGCHATID')
     log_filter: list[str] = Field(alias='LOGFILTER')
     banner_start: str = Field(alias='BANNERSTART')
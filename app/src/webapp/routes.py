@@ -1,14 +1,21 @@
+import base64
+import hashlib
+import json
 from pathlib import Path
 
 from aiohttp.web_fileresponse import FileResponse
 from aiohttp.web_request import Request
-from aiohttp.web_response import json_response
+from aiohttp.web_response import Response, json_response
 
 from aiogram import Bot
 from aiogram.utils.web_app import safe_parse_webapp_init_data
 
+from repositories import SkuRepository
 # from app.src.repositories import TrackedSkuRepository
 
+LIST_PAGE_SIZE = 50
+LIST_MAX_PAGE_SIZE = 200
+
 async def list_handler(request: Request):
     return FileResponse(Path(__file__).parent.resolve() / 'html/list.html')
 
@@ -22,18 +29,72 @@ async def api_list_handler(request: Request):
     except ValueError:
         return json_response({"ok": False, "error": "Unauthorized"}, status=401)
 
+    try:
+        params = list_params(jsondata)
+    except (ValueError, TypeError):
+        return json_response({"ok": False, "error": "Bad request"}, status=400)
+
     chat_id = str(webapp_data.user.id)
-    items = []
     sku_repository = request.app['sku_repository']
-    async for sku in sku_repository.find({'chat_id': chat_id}):
-        items.append({
-            'name': sku.name,
-            'variant': sku.variant,
-            'store': sku.store,
-            'code': sku.doc_id
-        })
-    
-    return json_response(data=items)
+    user_repository = request.app['user_repository']
+
+    # The version changes on every insert, delete and visible price or stock update of the user's items
+    version = await user_repository.sku_version(chat_id)
+    key = json.dumps([chat_id, version, {k: v for k, v in jsondata.items() if k != '_auth'}], sort_keys=True)
+    etag = '"' + hashlib.md5(key.encode()).hexdigest() + '"'
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+    if request.headers.get('If-None-Match') == etag:
+        return Response(status=304, headers=headers)
+
+    documents, after = await sku_repository.list_page(chat_id, **params)
+    items = [
+        {
+            'name': document['name'],
+            'variant': document['variant'],
+            'store': document['store'],
+            'price': document['price'],
+            'currency': document['currency'],
+            'instock': document['instock'],
+            'code': document['_id']
+        }
+        for document in documents
+    ]
+    next_cursor = base64.urlsafe_b64encode(json.dumps(after).encode()).decode() if after else None
+
+    return json_response(data={'items': items, 'next_cursor': next_cursor}, headers=headers)
+
+
+def list_params(jsondata: dict) -> dict:
+    filters = {}
+    if jsondata.get('store'):
+        filters['store'] = str(jsondata['store'])
+    if jsondata.get('instock') is not None:
+        filters['instock'] = bool(jsondata['instock'])
+    price = {}
+    if jsondata.get('price_min') is not None:
+        price['$gte'] = int(jsondata['price_min'])
+    if jsondata.get('price_max') is not None:
+        price['$lte'] = int(jsondata['price_max'])
+    if price:
+        filters['price'] = price
+
+    sort = jsondata.get('sort') or 'name'
+    if sort not in SkuRepository.LIST_SORTS:
+        raise ValueError(f'Unknown sort {sort}')
+
+    after = None
+    if jsondata.get('cursor'):
+        after = json.loads(base64.urlsafe_b64decode(jsondata['cursor']))
+        if not isinstance(after, list) or len(after) != 2:
+            raise ValueError('Bad cursor')
+
+    return {
+        'filters': filters,
+        'sort': sort,
+        'descending': jsondata.get('order') == 'desc',
+        'after': after,
+        'limit': min(max(int(jsondata.get('limit') or LIST_PAGE_SIZE), 1), LIST_MAX_PAGE_SIZE)
+    }
 
 
 async def api_delete_handler(request: Request):
@@ -0,0 +1,43 @@
+import asyncio
+import logging
+from time import monotonic
+
+import app
+import clients
+import parsing
+from config import PARSE_WORKERS, WORKER_ID
+from database import close_database
+
+IDLE_SECONDS = 10
+SETTINGS_RELOAD_SECONDS = 300
+
+
+async def main():
+    await app.load_settings()
+    await app.ensureIndexes()
+    app.bot = app.createBot()
+    await clients.registry.open()
+    if PARSE_WORKERS:
+        parsing.start_parse_pool(PARSE_WORKERS)
+
+    logging.info(f'Crawl worker {WORKER_ID} started')
+    settings_loaded = monotonic()
+    try:
+        while True:
+            if monotonic() - settings_loaded >= SETTINGS_RELOAD_SECONDS:
+                await app.load_settings()
+                settings_loaded = monotonic()
+
+            # Stores whose crawl ran out of due products are restarted here, the others keep going
+            app.startCrawls()
+            await asyncio.sleep(IDLE_SECONDS)
+    finally:
+        await app.stopCrawls()
+        parsing.stop_parse_pool()
+        await clients.registry.close()
+        await app.bot.session.close()
+        await close_database()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())